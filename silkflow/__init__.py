@@ -1,2 +1,2 @@
-from . import html
-from .core import router, effect, callback, Signal, sync_effects
+from . import charts, html
+from .core import router, effect, callback, Signal, Stream, computed, component, for_each, sync_effects, batch
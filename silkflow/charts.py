@@ -0,0 +1,204 @@
+import abc
+from typing import List, Optional, Tuple, Union
+
+from . import html
+from .core import Signal, Stream, _Effect, effect
+
+# Columns drawn before x is rebased to start again from the width, with the
+# chart re-rendered whole once. Renderers work in single precision floats,
+# which can't place columns a pixel apart much beyond a few million.
+REBASE_COLUMNS = 1 << 16
+
+
+class _Chart(abc.ABC):
+    """
+    Chart scrolling right to left across width pixel columns, each averaging
+    the samples that fall within it. Columns are items of a Stream kept to the
+    width, within a group scrolled by a transform, so drawing a column costs
+    one item and one attribute however long the chart has run.
+
+    Columns are tuples starting with their x, rebased every REBASE_COLUMNS.
+    """
+
+    __slots__ = [
+        "width",
+        "height",
+        "minimum",
+        "maximum",
+        "per_pixel",
+        "_columns",
+        "_count",
+        "_rebases",
+        "_samples",
+        "_last",
+    ]
+
+    def __init__(
+        self,
+        width: int = 100,
+        height: int = 20,
+        minimum: float = 0.0,
+        maximum: float = 1.0,
+        window: Optional[int] = None,
+    ) -> None:
+        """
+        Initializes the chart.
+
+        Args:
+            width: Width in pixels, one column each.
+            height: Height in pixels.
+            minimum: Value drawn at the bottom, lower values are clamped.
+            maximum: Value drawn at the top, higher values are clamped.
+            window: Samples shown across the width, defaulting to one a column.
+        """
+        if maximum <= minimum:
+            raise ValueError("Chart maximum must be greater than its minimum")
+        self.width = width
+        self.height = height
+        self.minimum = minimum
+        self.maximum = maximum
+        self.per_pixel = max(1, round((window or width) / width))
+        # columns drawn, as clients hold them
+        self._columns = Stream(maxlen=width)
+        # columns drawn so far, the x of the next
+        self._count = Signal(0)
+        # times x has been rebased, each re-rendering the chart
+        self._rebases = Signal(0)
+        # samples of the column being filled
+        self._samples = []
+        # y of the last column drawn
+        self._last = None
+
+    def add(self, value: float) -> None:
+        """
+        Adds a sample, drawing a column once it has per_pixel samples. Like
+        any signal write, the column is sent with the next sync_effects().
+
+        Args:
+            value: The sample.
+        """
+        self._samples.append(value)
+        if len(self._samples) < self.per_pixel:
+            return
+
+        mean = sum(self._samples) / len(self._samples)
+        self._samples = []
+        scaled = (mean - self.minimum) / (self.maximum - self.minimum)
+        y = self.height * (1 - min(max(scaled, 0.0), 1.0))
+
+        x = self._count.value
+        if x >= REBASE_COLUMNS:
+            x = self._rebase(x - self.width)
+        self._columns.append(self._column(x, y))
+        self._count.value = x + 1
+        self._last = y
+
+    def _column(self, x: int, y: float) -> tuple:
+        return (x, y)
+
+    def _rebase(self, offset: int) -> int:
+        # the columns held by clients are replaced as the chart re-renders
+        self._columns = Stream(
+            [(c[0] - offset,) + c[1:] for c in self._columns.value],
+            maxlen=self.width,
+        )
+        self._rebases.value += 1
+        return self._count.value - offset
+
+    @abc.abstractmethod
+    def _render_column(self, column: tuple) -> List[Union[str, _Effect]]:
+        """Renders a column, as returned by _column(), as an svg element"""
+
+    def _group_attributes(self) -> dict:
+        return {}
+
+    def __call__(self, **attributes) -> List[Union[str, _Effect]]:
+        """
+        Renders the chart as an svg element.
+
+        Args:
+            **attributes: Attributes of the svg element.
+
+        Returns:
+            The svg element.
+        """
+
+        @effect
+        def scroll():
+            # the last column drawn at the right edge
+            return f"translate({self.width - self._count.value},0)"
+
+        @effect
+        def group():
+            self._rebases.value
+            return html.g(
+                self._columns.each(self._render_column),
+                transform=scroll(),
+                **self._group_attributes(),
+            )
+
+        return html.svg(
+            group(),
+            viewBox=f"0 0 {self.width} {self.height}",
+            width=str(self.width),
+            height=str(self.height),
+            preserveAspectRatio="none",
+            **attributes,
+        )
+
+
+class Sparkline(_Chart):
+    """
+    Line chart of the latest samples, drawn in the current text color.
+
+    Usage:
+        speed = silkflow.charts.Sparkline(width=120, maximum=12.0, window=600)
+
+        @app.get("/")
+        @silkflow.effect(render=True)
+        def page():
+            return html.div(speed(Class="trend"))
+
+        speed.add(6.4)
+    """
+
+    __slots__ = []
+
+    def _column(self, x: int, y: float) -> Tuple[int, float, float]:
+        # joined to the previous column
+        return (x, y if self._last is None else self._last, y)
+
+    def _render_column(self, column: tuple) -> List[Union[str, _Effect]]:
+        x, y0, y1 = column
+        return html.path(d=f"M{x - 1} {y0:.1f}L{x} {y1:.1f}")
+
+    def _group_attributes(self) -> dict:
+        return {"fill": "none", "stroke": "currentColor"}
+
+
+class Bars(_Chart):
+    """
+    Bar chart of the latest samples, a pixel wide bar a column, drawn in the
+    current text color.
+
+    Usage:
+        wind = silkflow.charts.Bars(width=120, maximum=30.0)
+
+        @app.get("/")
+        @silkflow.effect(render=True)
+        def page():
+            return html.div(wind(Class="gusts"))
+
+        wind.add(14.2)
+    """
+
+    __slots__ = []
+
+    def _render_column(self, column: tuple) -> List[Union[str, _Effect]]:
+        x, y = column
+        return html.rect(
+            x=str(x), y=f"{y:.1f}", width="1", height=f"{self.height - y:.1f}"
+        )
+
+    def _group_attributes(self) -> dict:
+        return {"fill": "currentColor"}
@@ -1,16 +1,22 @@
 import asyncio
+import bisect
+import contextlib
 import functools
+import gzip
+import hashlib
+import inspect
 import itertools
+import json
 import uuid
 import weakref
 from collections import deque
 from html import escape
-from typing import Callable, List, Optional, Union
+from typing import Callable, List, Optional, Tuple, Union
 import time
 
 import fastapi
 from fastapi import APIRouter
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from . import js
 
@@ -19,52 +25,251 @@ router = APIRouter()
 
 CALLBACK_URL = "/callback"
 EFFECTS_URL = "/effects"
+EFFECTS_STREAM_URL = "/effects/stream"
+WEBSOCKET_URL = "/ws"
+RUNTIME_URL = "/silkflow.js"
 LOG_URL = "/log"
 
-# Maximum number of updates that are retained. A client falling befhind by more
-# than this will be forced to reload the page.
-BACKLOG_LEN = 5
+# Maximum size, in characters of html, of the updates that are retained. A
+# client falling behind by more than this is sent the current html of every
+# top level effect instead.
+BACKLOG_BYTES = 64 * 1024
+
+
+# Responses of at least this many bytes are gzipped for clients accepting it
+GZIP_MIN_SIZE = 512
+GZIP_LEVEL = 6
+
+# Seconds an idle long poll, stream or socket waits before being sent an empty
+# heartbeat, keeping idle connections open through proxies.
+POLL_TIMEOUT = 30.0
+# Maximum number of waiting long polls, streams and sockets, in total and per
+# client address. Beyond either, the client's oldest is released, or beyond
+# the total with none of its own waiting, the newcomer is told to retry later.
+MAX_POLLERS = 256
+MAX_POLLERS_PER_CLIENT = 4
+
+# names interned by the compact wire format before its table is restarted
+NAMES_LIMIT = 4096
+
+# fragments at least this long are sent as a splice of the previous version,
+# where that's at most DIFF_RATIO of the fragment
+DIFF_MIN_SIZE = 256
+DIFF_RATIO = 0.5
+
+# Future awaited by everything waiting on the next backlog entry. It's
+# resolved, and a new one created by the next waiter, as each entry is
+# published, so waking doesn't depend on the number of waiters.
+_generation = None
+_session_id = uuid.uuid4().hex[:8]
 
 
-_sync_condition = None
-_session_id = uuid.uuid4().hex[:8]
+def _publish() -> None:
+    global _generation
 
-async def sync_effects() -> None:
-    global _sync_condition
+    if _generation is None:
+        return
+    loop = _generation.get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is not loop:
+        # written off the event loop, say by a thread reading a sensor, where
+        # the waiters' future can't be resolved directly
+        loop.call_soon_threadsafe(_publish)
+        return
 
-    if _sync_condition is None:
-        _sync_condition = asyncio.Condition()
+    if not _generation.done():
+        _generation.set_result(None)
+    _generation = None
 
-    async with _sync_condition:
-        _Effect.push_updates()
-        _sync_condition.notify_all()
+
+async def sync_effects() -> None:
+    if _Effect.push_updates():
+        _publish()
 
 
 class _Effect:
     # note: __weakref__ required to support weak references with __slots__
-    __slots__ = ["index", "key", "_html", "render_func", "__weakref__"]
+    __slots__ = [
+        "index",
+        "key",
+        "_html",
+        "_deps",
+        "_parent",
+        "_published",
+        "_sent",
+        "_cache",
+        "render_func",
+        "__weakref__",
+    ]
     _stale_effects = set()
-    # backlog of consolidated effects - limited to BACKLOG_LEN
+    # backlog of consolidated effects - limited to BACKLOG_BYTES
     _backlog = deque()
     _backlog_offs: int = 0
+    _backlog_bytes: int = 0
+    # encoded updates, by the (from, to) state they span, whether compact and
+    # the diffs usable by the client
+    _encoded = {}
+    # states of the fragments diffs were taken against, by span
+    _diff_bases = {}
 
     @staticmethod
-    def push_updates() -> None:
+    def push_updates() -> bool:
+        """
+        Consolidates stale effects into a new backlog entry.
+
+        Returns:
+            bool: True if a backlog entry was added, False if nothing changed.
+        """
         if len(_Effect._stale_effects) > 0:
-            _Effect._backlog.append(
-                tuple(
-                    (h().key, h().index, h().html)
-                    for h in _Effect._stale_effects
-                    if h() is not None
-                )
-            )
+            # lists and streams reconcile as they're pushed, flushing list
+            # items whose values changed along with them
+            for h in tuple(_Effect._stale_effects):
+                if isinstance(h(), _Sequence):
+                    h()._reconcile()
 
+            stale = set(h() for h in _Effect._stale_effects) - {None}
             _Effect._stale_effects = set()
 
-            if len(_Effect._backlog) > BACKLOG_LEN:
+            # Effects nested within a stale effect are re-rendered as part of
+            # their ancestor's html (and their keys may not survive it), so
+            # only the outermost stale effects are pushed, shallowest first.
+            # Lists and streams only add and move their items around, they
+            # don't re-render them.
+            outermost = []
+            for e in stale:
+                depth = 0
+                for a in e._ancestors():
+                    if a in stale and not isinstance(a, _Sequence):
+                        break
+                    depth += 1
+                else:
+                    outermost.append((depth, e))
+            outermost.sort(key=lambda d: d[0])
+
+            state = _Effect._backlog_offs + len(_Effect._backlog)
+            updates = []
+            for _, e in outermost:
+                if isinstance(e, _Sequence):
+                    ops, e._ops = e._ops, []
+                if e.key is None:
+                    # not (or no longer) placed on the page
+                    continue
+                # the fragments enclosing this one, to coalesce against
+                outer = frozenset(
+                    (a.key, a.index)
+                    for a in e._ancestors()
+                    if a.key is not None and not isinstance(a, _Sequence)
+                )
+                if isinstance(e, _Sequence):
+                    if ops:
+                        updates += [(e.key, op, html, outer, None) for op, html in ops]
+                        e._sent = (state, None)
+                    continue
+
+                html = e.html
+                # skip effects that re-rendered to what clients already have
+                published = hash(html)
+                if published != e._published:
+                    e._published = published
+                    updates.append((e.key, e.index, html, outer, e._diff(html)))
+                    e._sent = (state, html if len(html) >= DIFF_MIN_SIZE else None)
+
+            if len(updates) == 0:
+                return False
+
+            _Effect._backlog.append(tuple(updates))
+            _Effect._encoded = {}
+            _Effect._diff_bases = {}
+            _Effect._backlog_bytes += sum(len(u[2]) for u in updates)
+
+            # always retain the latest entry
+            while _Effect._backlog_bytes > BACKLOG_BYTES and len(_Effect._backlog) > 1:
+                _Effect._backlog_bytes -= sum(len(u[2]) for u in _Effect._backlog[0])
                 _Effect._backlog.popleft()
                 _Effect._backlog_offs += 1
 
+            return True
+
+        return False
+
+    @staticmethod
+    def coalesce(
+        entries, start: Optional[int] = None, since: Optional[int] = None
+    ) -> List[tuple]:
+        """
+        Consolidates a run of backlog entries into the (key, index, html)
+        updates a client still needs, dropping updates superseded by a later
+        update of the same (key, index) or of an enclosing fragment.
+
+        Given the state of the first entry, and the state since which the
+        client holds the fragments it was sent, html is a [prefix, suffix,
+        middle] splice of the fragment the client holds where one was taken.
+
+        List operations are always kept, and as they shift the positions of
+        the list's items, earlier updates of its items are too.
+        """
+        replaced = set()
+        result = []
+        for entry in reversed(entries):
+            for key, index, html, outer, diff in reversed(entry):
+                if isinstance(index, tuple):
+                    if replaced.isdisjoint(outer):
+                        replaced = {r for r in replaced if r[0] != key}
+                        result.append((key, index, html))
+                    continue
+                if (key, index) in replaced or not replaced.isdisjoint(outer):
+                    continue
+                replaced.add((key, index))
+                usable = since is not None and diff is not None
+                if usable and since <= diff[0] < start:
+                    html = list(diff[1:])
+                result.append((key, index, html))
+        result.reverse()
+        return result
+
+    def _diff(self, html: str) -> Optional[tuple]:
+        # a splice of the fragment last sent, while it's what clients hold
+        if self._sent is None or self._sent[1] is None or len(html) < DIFF_MIN_SIZE:
+            return None
+        base_state, base = self._sent
+        for a in self._ancestors():
+            if a._sent is not None and a._sent[0] > base_state:
+                # since re-rendered within an enclosing fragment
+                return None
+
+        # common prefix and suffix by bisection, comparing natively only the
+        # part not yet known to match
+        n = min(len(base), len(html))
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if html.startswith(base[lo:mid], lo):
+                lo = mid
+            else:
+                hi = mid - 1
+        prefix = lo
+        lo, hi = 0, n - prefix
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if html.endswith(base[len(base) - mid : len(base) - lo], 0, len(html) - lo):
+                lo = mid
+            else:
+                hi = mid - 1
+        middle = html[prefix : len(html) - lo]
+        if len(middle) > len(html) * DIFF_RATIO:
+            return None
+
+        # clients count in UTF-16 code units
+        return (
+            base_state,
+            len(html[:prefix].encode("utf-16-le")) // 2,
+            len(html[len(html) - lo :].encode("utf-16-le")) // 2,
+            middle,
+        )
+
     @staticmethod
     def _concat(html: List[Union[str, "_Effect"]]) -> List[Union[str, "_Effect"]]:
         # Group consecutive elements by their type
@@ -83,21 +288,55 @@ class _Effect:
     ) -> None:
         self.render_func = render_func
 
-        self._html: List[Union[str, "_Effect"]] = _Effect._concat(html)
-
         self.index = None
         self.key = None
+        # signals read by the most recent render
+        self._deps = set()
+        # weak reference to the enclosing effect, if any
+        self._parent = None
+        # hash of the html last sent to clients
+        self._published = None
+        # state of the backlog entry last sending this, and what it sent if
+        # long enough to diff against
+        self._sent = None
+        # rendered html, cleared when this or a nested effect is flushed
+        self._cache = None
+
+        self._html: List[Union[str, "_Effect"]] = []
+        self._set_html(html)
 
     def flush(self) -> None:
         self._html = []
+        self._cache = None
+        for a in self._ancestors():
+            a._cache = None
         _Effect._stale_effects.add(weakref.ref(self))
 
+    def _set_html(self, html: List[Union[str, "_Effect"]]) -> None:
+        self._html = _Effect._concat(html)
+        for c in self._html:
+            if isinstance(c, _Effect):
+                c._parent = weakref.ref(self)
+
+    def _render(self) -> None:
+        self._set_html(_track(self, self.render_func))
+
+    def _ancestors(self):
+        parent = self._parent() if self._parent is not None else None
+        while parent is not None:
+            yield parent
+            parent = parent._parent() if parent._parent is not None else None
+
     def __str__(self) -> str:
-        if len(self._html) == 0 and self.render_func is not None:
-            result = self.render_func()
-            self._html = _Effect._concat(result)
+        if self._cache is None:
+            if len(self._html) == 0 and self.render_func is not None:
+                self._render()
+
+            self._cache = "".join(str(h) for h in self._html)
+            if self._published is None:
+                self._published = hash(self._cache)
 
-        return "".join(str(h) for h in self._html)
+        return self._cache
 
     @property
     def html(self) -> str:
@@ -108,6 +347,260 @@ class _Effect:
         return [c for c in self._html if isinstance(c, _Effect)]
 
 
+def _longest_increasing(seq: List[int]) -> set:
+    """Positions in seq of a longest strictly increasing subsequence"""
+    tails = []
+    tail_values = []
+    previous = [None] * len(seq)
+    for i, x in enumerate(seq):
+        j = bisect.bisect_left(tail_values, x)
+        previous[i] = tails[j - 1] if j > 0 else None
+        if j == len(tails):
+            tails.append(i)
+            tail_values.append(x)
+        else:
+            tails[j] = i
+            tail_values[j] = x
+
+    result = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        result.add(i)
+        i = previous[i]
+    return result
+
+
+class _Sequence(_Effect):
+    """
+    Effect sent as operations on its element's children, which it must be
+    the only content of, rather than re-rendered. Operations are decided as
+    it's pushed, so pages served meanwhile still match the backlog state.
+
+    Operations take the place of the child index, with html for those adding
+    an item. Subclasses implement _reconcile(), called as stale sequences are
+    pushed, appending the operations bringing clients up to date to _ops.
+    """
+
+    __slots__ = ["_ops"]
+
+    def __init__(self, render_func: Optional[Callable] = None) -> None:
+        # (operation, html) yet to be pushed
+        self._ops = []
+        super().__init__([], render_func=render_func)
+
+    def flush(self) -> None:
+        _Effect._stale_effects.add(weakref.ref(self))
+
+
+class _List(_Sequence):
+    """
+    Effect rendering an item effect per value of a list signal, kept by key.
+    Changes to the list are reconciled into the remove, insert and move
+    operations turning the items clients hold into the new ones, leaving
+    items that stay put untouched.
+
+    The operations are ("-", position) removing an item, ("+", position)
+    inserting the html as one, and ("m", from, to) moving an item, to being
+    its position once removed.
+    """
+
+    __slots__ = ["_key_fn", "_render_item", "_order", "_items", "_values"]
+
+    def __init__(self, signal: "Signal", key_fn: Callable, render_item: Callable):
+        self._key_fn = key_fn
+        self._render_item = render_item
+        # keys in the order their items are rendered in
+        self._order = []
+        # item effects, and the values they were rendered from, by key
+        self._items = {}
+        self._values = {}
+        super().__init__(render_func=lambda: list(signal.value))
+        self._reconcile()
+        self._ops = []
+
+    def _reconcile(self) -> None:
+        values = _track(self, self.render_func)
+        keys = [self._key_fn(v) for v in values]
+        if len(set(keys)) != len(keys):
+            raise ValueError("for_each keys must be unique")
+        new = dict(zip(keys, values))
+        order = self._order
+
+        # removed items, from the end so positions hold
+        for pos in range(len(order) - 1, -1, -1):
+            if order[pos] not in new:
+                item = self._items.pop(order[pos])
+                del self._values[order[pos]]
+                item._parent = None
+                item.key = None
+                del order[pos]
+                self._ops.append((("-", pos), ""))
+
+        # items not in a longest run already in order are moved, last first,
+        # ahead of their successor, and new items inserted there
+        position = {k: i for i, k in enumerate(keys)}
+        stay = {order[i] for i in _longest_increasing([position[k] for k in order])}
+        for i in range(len(keys) - 1, -1, -1):
+            k = keys[i]
+            if k in stay:
+                continue
+            to = order.index(keys[i + 1]) if i + 1 < len(keys) else len(order)
+            if k in self._items:
+                frm = order.index(k)
+                del order[frm]
+                if frm < to:
+                    to -= 1
+                order.insert(to, k)
+                self._ops.append((("m", frm, to), ""))
+            else:
+                render = functools.partial(self._render_item, new[k])
+                item = _Effect([], render_func=render)
+                item._render()
+                item._parent = weakref.ref(self)
+                item.key = self.key
+                self._items[k] = item
+                self._values[k] = new[k]
+                order.insert(to, k)
+                self._ops.append((("+", to), item.html))
+
+        # items kept whose values changed are re-rendered
+        for k, v in new.items():
+            try:
+                changed = self._values[k] != v
+            except:
+                changed = True
+            if changed:
+                self._values[k] = v
+                item = self._items[k]
+                item.render_func = functools.partial(self._render_item, v)
+                item.flush()
+
+        self._html = [self._items[k] for k in order]
+        for i, item in enumerate(self._html):
+            item.key, item.index = self.key, i
+        self._cache = None
+        for a in self._ancestors():
+            a._cache = None
+
+    def __str__(self) -> str:
+        if self._cache is None:
+            # the list's own key and index are assigned once it's placed
+            for i, item in enumerate(self._html):
+                item.key, item.index = self.key, i
+            self._cache = "".join(str(item) for item in self._html)
+
+        return self._cache
+
+
+def for_each(signal: "Signal", key_fn: Callable, render_item: Callable) -> _List:
+    """
+    Renders an item per value of a list signal, each item an effect kept for
+    as long as its key is in the list. When the list changes, clients are sent
+    only the items removed, inserted and moved, and the items whose values
+    changed, rather than the whole list.
+
+    The list must be the only child of its element, and each item must
+    render as a single element.
+
+    Usage:
+        @silkflow.effect
+        def race_log():
+            return html.tbody(
+                silkflow.for_each(laps, lambda lap: lap.number, lap_row)
+            )
+
+    Args:
+        signal: Signal holding the list of values.
+        key_fn: Function of a value returning its unique, hashable key.
+        render_item: Function of a value returning its element.
+
+    Returns:
+        _List: The list effect, placed as an element's only child.
+    """
+    return _List(signal, key_fn, render_item)
+
+
+class _StreamView(_Sequence):
+    """
+    Effect rendering an item per value of a Stream. Values added are sent as
+    (">", maxlen) appending the html as an item, or ("<", maxlen) prepending
+    it, and clients trim items from the other end to maxlen.
+    """
+
+    __slots__ = ["_stream", "_render_item", "_items", "_pending"]
+
+    def __init__(self, stream: "Stream", render_item: Callable) -> None:
+        super().__init__()
+        self._stream = stream
+        self._render_item = render_item
+        # the rendered items, as clients hold them
+        self._items = deque()
+        # (end, value) added since last pushed
+        self._pending = []
+        for value in stream._value:
+            self._items.append(self._render_value(value))
+
+    def _render_value(self, value) -> List[Union[str, _Effect]]:
+        item = _Effect._concat(self._render_item(value))
+        for c in item:
+            if isinstance(c, _Effect):
+                c._parent = weakref.ref(self)
+        return item
+
+    def _reconcile(self) -> None:
+        maxlen = self._stream.maxlen
+        for end, value in self._pending:
+            item = self._render_value(value)
+            if maxlen is not None and len(self._items) >= maxlen:
+                trimmed = self._items.popleft() if end == ">" else self._items.pop()
+                # effects within no longer on the page
+                for c in trimmed:
+                    if isinstance(c, _Effect):
+                        c._parent = None
+                        c.key = None
+            if end == ">":
+                self._items.append(item)
+            else:
+                self._items.appendleft(item)
+            self._ops.append(((end, maxlen), "".join(str(h) for h in item)))
+        self._pending = []
+
+        self._cache = None
+        for a in self._ancestors():
+            a._cache = None
+
+    def __str__(self) -> str:
+        if self._cache is None:
+            self._cache = "".join(str(h) for item in self._items for h in item)
+
+        return self._cache
+
+
+_KEY_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+_key_counter = itertools.count()
+
+
+def _new_key() -> str:
+    """
+    Allocates a short base 36 key for an element owning an effect, or for a
+    callback. Keys are only unique within a _session_id, clients of a previous
+    session are made to reload before their keys are used.
+    """
+    n = next(_key_counter)
+    key = _KEY_DIGITS[n % 36]
+    while n >= 36:
+        n //= 36
+        key = _KEY_DIGITS[n % 36] + key
+    return key
+
+
+def _attribute(name: str, value) -> str:
+    # boolean attributes are only present or absent
+    if isinstance(value, bool) and value:
+        return f" {name}"
+    return f' {name}="{escape(value)}"'
+
+
 def _factory(tag_name, allow_children=True):
     def _impl(*children, **attributes):
         if "children" in attributes:
@@ -121,18 +614,30 @@ def _factory(tag_name, allow_children=True):
         if not allow_children and children:
             raise ValueError(f"<{tag_name} /> cannot have children")
 
-        # pre-allocated key for just in case
-        key = uuid.uuid4().hex[:8]
+        # allocated once an effect is found
+        key = None
         owns_effect = False
+        # while compiling a component, whether a key is needed is only decided
+        # per instance
+        key_slot = None
         # render the children first so we know if a effect is present
         if allow_children:
             result = [">"]
             for idx, c in enumerate(children):
+                placing = isinstance(c, _Effect) and c.key is None
+                if placing and isinstance(c, _Sequence) and len(children) != 1:
+                    raise ValueError(
+                        f"<{tag_name} /> lists and streams must be the only child"
+                    )
                 if isinstance(c, _Effect) and c.key is None:
+                    key = key or _new_key()
                     c.index = idx
                     c.key = key
                     result.append(c)
                     owns_effect = True
+                elif isinstance(c, _Slot):
+                    key_slot = key_slot or _KeySlot()
+                    result.append(_SlotUse(c.arg, key_slot, idx))
                 elif isinstance(c, list):
                     result += c
                 else:
@@ -143,30 +648,258 @@ def _factory(tag_name, allow_children=True):
 
         # now go back and build the tag and attributes
         preface = [f"<{tag_name}"]
-        if attributes or owns_effect:
+        if attributes or owns_effect or key_slot is not None:
             for k, v in sorted(attributes.items()):
                 if isinstance(v, _Effect) and v.key is None:
+                    key = key or _new_key()
                     v.index = k
                     v.key = key
                     preface += [f' {k}="', v, '"']
                     owns_effect = True
+                elif isinstance(v, _Slot):
+                    key_slot = key_slot or _KeySlot()
+                    # formatted whole per instance, boolean attributes included
+                    preface.append(_SlotUse(v.arg, key_slot, k))
                 # elif iscallable(v):
                 # TODO: support callbacks more cleanly
-                elif isinstance(v, bool) and v:
-                    preface.append(f" {k}")
                 else:
-                    preface.append(f' {k}="{escape(v)}"')
+                    preface.append(_attribute(k, v))
 
             if owns_effect:
                 preface.append(f' key="{key}"')
 
+            if key_slot is not None and not owns_effect:
+                preface.append(key_slot)
+
         return preface + result
 
     return _impl
 
 
+def _is_element(value: list) -> bool:
+    # flat, as elements are, their effects keyed as they were placed
+    return all(
+        isinstance(p, str) or (isinstance(p, _Effect) and p.key is not None)
+        for p in value
+    )
+
+
+class _Slot:
+    """Placeholder for a component argument while its template is compiled"""
+
+    __slots__ = ["arg"]
+
+    def __init__(self, arg: Union[int, str]) -> None:
+        self.arg = arg
+
+    def _misuse(self, *args):
+        raise TypeError(
+            "Component arguments may only be used as element children or attribute values"
+        )
+
+    # hashing too, as dict lookups and set membership would otherwise quietly
+    # take one branch for every call
+    __str__ = __bool__ = __eq__ = __hash__ = _misuse
+
+
+class _SlotUse:
+    """A single use of a component argument within a compiled template"""
+
+    __slots__ = ["arg", "key_slot", "index"]
+
+    def __init__(self, arg: Union[int, str], key_slot: "_KeySlot", index) -> None:
+        self.arg = arg
+        self.key_slot = key_slot
+        # child index or attribute name, as for _Effect.index
+        self.index = index
+
+
+class _KeySlot:
+    """Position of an element's key attribute, emitted only if an instance needs it"""
+
+    __slots__ = []
+
+
+class _Template:
+    """
+    Component output with the static markup pre-joined, leaving only the
+    positions of arguments (and of any keys they need) to fill per call.
+    """
+
+    __slots__ = ["parts", "uses"]
+
+    def __init__(self, parts: List[Union[str, _SlotUse, _KeySlot]]) -> None:
+        self.parts = _Effect._concat(parts)
+        self.uses = [p for p in self.parts if isinstance(p, _SlotUse)]
+
+    @staticmethod
+    def compile(fn: Callable, shape) -> Optional["_Template"]:
+        nargs, kwnames, constants, _ = shape
+        constants = dict(constants)
+        args = [constants.get(i, _Slot(i)) for i in range(nargs)]
+        kwargs = {k: constants.get(k, _Slot(k)) for k in kwnames}
+        # signals read would be frozen into the template, and lost to the
+        # enclosing effect
+        _effect_stack.append(set())
+        try:
+            parts = fn(*args, **kwargs)
+        except Exception:
+            # arguments used for more than placing content
+            return None
+        finally:
+            deps = _effect_stack.pop()
+
+        if deps:
+            return None
+
+        if not isinstance(parts, list) or any(
+            isinstance(p, (_Effect, _Slot)) for p in parts
+        ):
+            # effects created by the component must be created per call, and
+            # arguments must be placed within an element
+            return None
+
+        return _Template(parts)
+
+    def matches(self, args: dict, placed: list, expected: list) -> bool:
+        """
+        Whether filling in args gives the output of a plain call with them,
+        which placed the given effects. Components checking the type of their
+        arguments, or comparing them by identity, take branches no placeholder
+        notices.
+        """
+        return _Effect._concat(self(args, placed)) == _Effect._concat(expected)
+
+    def __call__(self, args: dict, placed: list = ()) -> List[Union[str, _Effect]]:
+        # assign keys first, the key attribute precedes the children
+        keys = {}
+        for use in self.uses:
+            value = args[use.arg]
+            if isinstance(value, _Effect) and (
+                value.key is None or any(value is p for p in placed)
+            ):
+                if use.key_slot not in keys:
+                    # as already assigned by a plain call being compared with
+                    keys[use.key_slot] = value.key or _new_key()
+                value.key = keys[use.key_slot]
+                value.index = use.index
+
+        result = []
+        for p in self.parts:
+            if isinstance(p, str):
+                result.append(p)
+            elif isinstance(p, _SlotUse):
+                value = args[p.arg]
+                if not isinstance(p.index, str):
+                    if isinstance(value, list):
+                        # an element, already flat
+                        result += value
+                    else:
+                        result.append(value)
+                elif isinstance(value, _Effect):
+                    result += [f' {p.index}="', value, '"']
+                else:
+                    result.append(_attribute(p.index, value))
+            elif p in keys:
+                result.append(f' key="{keys[p]}"')
+
+        return result
+
+
+def component(fn: Callable) -> Callable:
+    """
+    Decorator compiling a function of html elements into a template. The
+    function is called once per call signature with placeholder arguments and
+    its static markup joined into prebuilt strings, so later calls only cost
+    filling in their arguments.
+
+    Arguments may only be used as element children or attribute values, not
+    inspected or formatted. Templates are compiled per argument type, with None
+    and booleans compiled in as they are, and checked against a plain call
+    before being kept. Components that do otherwise, read signals, create
+    effects themselves or are passed lists of elements fall back to being
+    called as plain functions.
+
+    Usage:
+        @silkflow.component
+        def row(name, value):
+            return html.tr(html.td(name, Class="name"), html.td(value))
+
+    Args:
+        fn: Function returning html elements.
+
+    Returns:
+        Callable: The component, taking the same arguments as fn.
+    """
+    templates = {}
+
+    @functools.wraps(fn)
+    def _impl(*args, **kwargs):
+        values = dict(enumerate(args), **kwargs)
+        if any(isinstance(v, _Slot) for v in values.values()):
+            # within the compilation of an enclosing component
+            return fn(*args, **kwargs)
+
+        if any(isinstance(v, list) and not _is_element(v) for v in values.values()):
+            # lists of elements are unpacked as children, shifting their indexes
+            return fn(*args, **kwargs)
+
+        # None and booleans are commonly branched on by identity, and types by
+        # isinstance() or type(), which no placeholder would notice
+        constants = frozenset(
+            (k, v) for k, v in values.items() if v is None or isinstance(v, bool)
+        )
+        types = tuple(type(a) for a in args) + tuple(
+            type(kwargs[k]) for k in sorted(kwargs)
+        )
+        shape = (len(args), tuple(sorted(kwargs)), constants, types)
+        if shape not in templates:
+            placed = [
+                v for v in values.values() if isinstance(v, _Effect) and v.key is None
+            ]
+            result = fn(*args, **kwargs)
+            template = _Template.compile(fn, shape)
+            if template is not None and not template.matches(values, placed, result):
+                template = None
+            templates[shape] = template
+            return result
+
+        template = templates[shape]
+        if template is None:
+            return fn(*args, **kwargs)
+        return template(values)
+
+    return _impl
+
+
 _effect_stack = []
 
+# body of each rendered page, the top level effects of which are used to
+# resync clients that have fallen off the backlog
+_pages = []
+
+
+def _track(target, func: Callable):
+    """
+    Calls func, subscribing target to exactly the signals it reads.
+
+    Dependencies are re-tracked on every call so that signals read by a newly
+    taken branch subscribe and signals no longer read are dropped.
+    """
+    _effect_stack.append(set())
+    try:
+        result = func()
+    finally:
+        deps = _effect_stack.pop()
+
+    for s in target._deps - deps:
+        s._unsubscribe(target)
+    for s in deps - target._deps:
+        s._subscribe(target)
+    target._deps = deps
+
+    return result
+
 
 def effect(*dec_args, **dec_kwargs):
     """
@@ -178,7 +911,8 @@ def effect(*dec_args, **dec_kwargs):
 
     If the "render" keyword argument is set to True, the decorator assumes the function
     is a render function. It creates a FastAPI-compatible function that returns an
-    HTMLResponse with the rendered content of the Silkflow application.
+    HTML response with the rendered content of the Silkflow application, gzipped
+    for clients accepting it.
 
     Usage:
         @effect
@@ -210,12 +944,9 @@ def effect(*dec_args, **dec_kwargs):
 
         @functools.wraps(dec_args[0])
         def _impl(*args, **kwargs):
-            _effect_stack.append(set())
-            value = dec_args[0](*args, **kwargs)
             func = functools.partial(dec_args[0], *args, **kwargs)
-            result = _Effect(value, render_func=func)
-            for c in _effect_stack.pop():
-                c.effects.add(weakref.ref(result))
+            result = _Effect([], render_func=func)
+            result._render()
             return result
 
         return _impl
@@ -223,27 +954,55 @@ def effect(*dec_args, **dec_kwargs):
 
         def _dec_impl(fn):
             @functools.wraps(fn)
-            def _impl2():
+            def _impl2(request=None):
                 # _impl has a effect attribute so we maintain a reference
                 if not hasattr(_impl2, "body"):
-                    _impl2.body = _factory("body")(
-                        fn(), **dec_kwargs.get("body_attrs", {})
+                    # as the root of the page's effects, the body's cached
+                    # html is dropped whenever any of them is flushed
+                    _impl2.body = _Effect(
+                        _factory("body")(fn(), **dec_kwargs.get("body_attrs", {}))
                     )
-                response = _Effect(
-                    js.render(
-                        _impl2.body,
-                        _session_id,
-                        CALLBACK_URL,
-                        EFFECTS_URL,
-                        LOG_URL,
-                        _Effect._backlog_offs + len(_Effect._backlog),
-                        head_elems=dec_kwargs.get("head_elems", []),
+                    _pages.append(_impl2.body)
+                    _impl2.document = None
+
+                state = _Effect._backlog_offs + len(_Effect._backlog)
+                body = _impl2.body.html
+                if (
+                    _impl2.document is None
+                    or _impl2.document[0] != state
+                    or _impl2.document[1] is not body
+                ):
+                    response = _Effect(
+                        js.render(
+                            [body],
+                            _session_id,
+                            state,
+                            DIFF_MIN_SIZE,
+                            f"{RUNTIME_URL}?v={_runtime_version}",
+                            head_elems=dec_kwargs.get("head_elems", []),
+                        )
                     )
-                )
-                return HTMLResponse(
-                    content="<!DOCTYPE html>" + response.html, status_code=200
+                    content = ("<!DOCTYPE html>" + response.html).encode()
+                    etag = hashlib.sha1(content).hexdigest()[:16]
+                    # compressed once per change rather than per request
+                    _impl2.document = (state, body, content, _gzip(content), etag)
+
+                _, _, content, gzipped, etag = _impl2.document
+                return _validated(
+                    request, content, "text/html", gzipped, etag, "no-cache"
                 )
 
+            # FastAPI passes the request, not fn's (lack of) arguments
+            _impl2.__signature__ = inspect.Signature(
+                [
+                    inspect.Parameter(
+                        "request",
+                        inspect.Parameter.POSITIONAL_OR_KEYWORD,
+                        default=None,
+                        annotation=fastapi.Request,
+                    )
+                ]
+            )
             fn = effect(fn)
 
             return _impl2
@@ -295,6 +1054,9 @@ class Signal(object):
         Args:
             value: The new value to be set for the signal.
         """
+        self._set(value)
+
+    def _set(self, value):
         try:
             # only update if the value hasn't changed
             # but don't barf if the type doesn't support __eq__ operator
@@ -303,10 +1065,205 @@ class Signal(object):
         except:
             pass
 
-        for o in self.effects:
-            if o() is not None:
-                o().flush()
+        # set first, computed signals recompute as soon as they are flushed
         self._value = value
+        self._notify()
+
+    def _notify(self) -> None:
+        # iterate a snapshot, flushing an effect may release nested effects
+        # whose finalizers then prune this set
+        for o in tuple(self.effects):
+            if _batch_depth > 0:
+                _batched_effects.add(o)
+            elif o() is not None:
+                o().flush()
+
+    def _subscribe(self, effect: _Effect) -> None:
+        # the callback drops the subscription once the effect is collected,
+        # keeping the set proportional to live effects
+        self.effects.add(weakref.ref(effect, self.effects.discard))
+
+    def _unsubscribe(self, effect: _Effect) -> None:
+        self.effects.discard(weakref.ref(effect))
+
+
+class _Computed(Signal):
+    """
+    A read-only Signal whose value is derived from other signals. The value is
+    cached and recomputed whenever an upstream signal changes, with downstream
+    effects only flushed if the recomputed value differs.
+    """
+
+    __slots__ = ["_func", "_deps", "__weakref__"]
+
+    def __init__(self, func: Callable):
+        super().__init__(None)
+        self._func = func
+        self._deps = set()
+        self._value = _track(self, func)
+
+    # read only
+    value = property(Signal.value.fget, doc=Signal.value.__doc__)
+
+    def flush(self) -> None:
+        self._set(_track(self, self._func))
+
+
+def computed(fn: Callable) -> _Computed:
+    """
+    Decorator creating a memoized, read-only signal from a function of other
+    signals. Effects reading the computed value are only re-rendered when the
+    value actually changes.
+
+    Usage:
+        @silkflow.computed
+        def average_speed():
+            return sum(samples.value) / len(samples.value)
+
+        @silkflow.effect
+        def speed():
+            return f"{average_speed.value:.1f}"
+
+    Args:
+        fn: Function computing the value from other signals.
+
+    Returns:
+        _Computed: A signal-like object exposing the cached value.
+    """
+    return _Computed(fn)
+
+
+class Stream(Signal):
+    """
+    Stream is a Signal holding a sequence that's only added to, at either end,
+    keeping at most maxlen values by dropping them from the other end.
+
+    Effects reading the value re-render as for any Signal, but views created
+    with each() only send clients the items added, so a log growing for hours
+    costs the same per entry as the first.
+
+    Attributes:
+        value: The current values, oldest first. Read only.
+        maxlen: The most values kept, or None if unbounded.
+    """
+
+    __slots__ = ["maxlen", "_views"]
+
+    def __init__(self, values=(), maxlen: Optional[int] = None):
+        """
+        Initializes the Stream.
+
+        Args:
+            values: Initial values, oldest first.
+            maxlen: The most values kept, or None if unbounded.
+        """
+        super().__init__(deque(values, maxlen))
+        self.maxlen = maxlen
+        self._views = weakref.WeakSet()
+
+    @property
+    def value(self) -> tuple:
+        """
+        The current values of the stream.
+
+        Returns:
+            tuple: The values, oldest first.
+        """
+        return tuple(Signal.value.fget(self))
+
+    def append(self, value) -> None:
+        """
+        Adds a value at the end, dropping the first beyond maxlen.
+
+        Args:
+            value: The value to add.
+        """
+        self._value.append(value)
+        self._added(">", value)
+
+    def prepend(self, value) -> None:
+        """
+        Adds a value at the start, dropping the last beyond maxlen.
+
+        Args:
+            value: The value to add.
+        """
+        self._value.appendleft(value)
+        self._added("<", value)
+
+    def _added(self, end: str, value) -> None:
+        for view in self._views:
+            view._pending.append((end, value))
+            view.flush()
+        self._notify()
+
+    def each(self, render_item: Callable) -> _StreamView:
+        """
+        Renders an item per value, sending clients only the items added. The
+        view must be the only child of its element, and each item must render
+        as a single element.
+
+        Usage:
+            log = silkflow.Stream(maxlen=500)
+
+            @app.get("/")
+            @silkflow.effect(render=True)
+            def page():
+                return html.ul(log.each(lambda entry: html.li(entry)))
+
+            log.append("tacked")
+
+        Args:
+            render_item: Function of a value returning its element.
+
+        Returns:
+            _StreamView: The view, placed as an element's only child.
+        """
+        view = _StreamView(self, render_item)
+        self._views.add(view)
+        return view
+
+
+_batch_depth = 0
+_batched_effects = set()
+
+
+@contextlib.contextmanager
+def batch():
+    """
+    Context manager (and decorator) deferring effect flushes until the
+    outermost batch exits. Effects touched by several writes are flushed once
+    and the combined updates are published as a single backlog entry, so
+    clients never observe a partially applied set of writes. Should the body
+    raise, the effects its writes touched are still flushed, the writes having
+    been made, but nothing is published; they're sent with the next
+    sync_effects().
+
+    Usage:
+        with silkflow.batch():
+            speed.value = 5.2
+            heading.value = 270
+
+        @silkflow.batch()
+        def update(...):
+            ...
+    """
+    global _batch_depth, _batched_effects
+
+    _batch_depth += 1
+    completed = False
+    try:
+        yield
+        completed = True
+    finally:
+        _batch_depth -= 1
+        if _batch_depth == 0:
+            effects, _batched_effects = _batched_effects, set()
+            for o in effects:
+                if o() is not None:
+                    o().flush()
+            if completed and _Effect.push_updates():
+                _publish()
 
 
 _callback_map = {}
@@ -330,7 +1287,7 @@ def callback(*dec_args, **dec_kwargs):
         ValueError: If the decorator is used improperly.
     """
     if len(dec_args) == 1 and callable(dec_args[0]):
-        id = uuid.uuid4().hex[:8]
+        id = _new_key()
         _callback_map[id] = dec_args[0]
         return f'return python("{id}")(arguments[0])'
     elif "confirm" in dec_kwargs:
@@ -338,7 +1295,7 @@ def callback(*dec_args, **dec_kwargs):
         confirm = 1 if isinstance(confirm, bool) and confirm else confirm
 
         def _dec_impl(fn):
-            id = uuid.uuid4().hex[:8]
+            id = _new_key()
             _callback_map[id] = fn
             return f'return confirm("{id}", {confirm})(arguments[0])'
 
@@ -351,13 +1308,11 @@ def callback(*dec_args, **dec_kwargs):
 async def _callback(
     id: str = fastapi.Body(embed=True),
     event: dict = fastapi.Body(embed=True),
+    session: str = fastapi.Body(embed=True),
 ):
-    if id in _callback_map:
-        _callback_map[id](event)
-
+    # callback ids are only unique within a session
+    if session == _session_id and _invoke_callback(id, event):
         current_time = int(time.time() * 1000)
-        # Don't yield here
-        asyncio.create_task(sync_effects())
         return dict(time=current_time)
 
     response = JSONResponse(content={})
@@ -366,45 +1321,477 @@ async def _callback(
     return response
 
 
+def _invoke_callback(id: str, event: dict) -> bool:
+    if id not in _callback_map:
+        return False
+
+    _callback_map[id](event)
+    # Don't yield here
+    asyncio.create_task(sync_effects())
+    return True
+
+
+@router.websocket(WEBSOCKET_URL)
+async def _websocket(
+    websocket: fastapi.WebSocket,
+    session: str,
+    state: int,
+    table: Optional[int] = None,
+    names: int = 0,
+    since: Optional[int] = None,
+):
+    """Carries callbacks from, and effects to, a client on one connection"""
+    await websocket.accept()
+    if session != _session_id:
+        await websocket.send_json(dict(redirect="/"))
+        await websocket.close()
+        return
+
+    async def send_effects(released):
+        nonlocal state, table, names, since
+        while not released.done():
+            previous = state
+            state, content = await _wait_effects(
+                state, table, names, since, released
+            )
+            if table is not None:
+                table, names = _names_table, len(_names)
+            if since is not None and previous < _Effect._backlog_offs:
+                # resynced, the client forgets the fragments it holds
+                since = state
+            await websocket.send_text(content.decode())
+        # released, the client backs off before reconnecting
+        await websocket.close(code=1013)
+
+    async def receive_callbacks():
+        while True:
+            try:
+                message = await websocket.receive_json()
+                id, event = message["id"], message["event"]
+            except (ValueError, TypeError, KeyError):
+                id = event = None
+            if not isinstance(id, str) or not isinstance(event, dict):
+                # not a callback, the client is broken rather than stale
+                await websocket.close(code=1008)
+                return
+            if not _invoke_callback(id, event):
+                await websocket.send_json(dict(redirect="/"))
+
+    with _poller(_client_address(websocket)) as released:
+        if released is None:
+            # try again later, closing before accepting wouldn't tell the client
+            await websocket.close(code=1013)
+            return
+        tasks = [
+            asyncio.create_task(send_effects(released)),
+            asyncio.create_task(receive_callbacks()),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # either ending, or failing, ends the connection
+            for task in tasks:
+                task.cancel()
+        # letting the other wind up
+        await asyncio.wait(tasks)
+
+    for task in done:
+        error = task.exception()
+        if error is not None and not isinstance(error, fastapi.WebSocketDisconnect):
+            raise error
+
+
 @router.get(EFFECTS_URL)
-async def _effects(session: str, state: int):
-    global _sync_condition
+async def _effects(
+    request: fastapi.Request,
+    session: str,
+    state: int,
+    table: Optional[int] = None,
+    names: int = 0,
+    since: Optional[int] = None,
+):
+    if session != _session_id:
+        response = JSONResponse(content={})
+        response.status_code = 200
+        response.headers["X-Redirect-URL"] = "/"
+        return response
+
+    with _poller(_client_address(request)) as released:
+        if released is None:
+            return fastapi.Response(status_code=503, headers={"Retry-After": "1"})
+        _, content = await _wait_effects(state, table, names, since, released)
+    if released.done():
+        # rather than an empty response the client would poll again at once
+        return fastapi.Response(status_code=503, headers={"Retry-After": "1"})
+    response = _compressed(request, content, "application/json")
+    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response.headers["Expires"] = "0"
+
+    return response
 
-    if session != _session_id or state < _Effect._backlog_offs:
+
+@router.get(EFFECTS_STREAM_URL)
+async def _effects_stream(
+    request: fastapi.Request,
+    session: str,
+    state: int,
+    table: Optional[int] = None,
+    names: int = 0,
+    since: Optional[int] = None,
+):
+    if session != _session_id:
+        # not an event stream, the client falls back to polling which redirects
         response = JSONResponse(content={})
         response.status_code = 200
         response.headers["X-Redirect-URL"] = "/"
         return response
 
-    if _sync_condition is None:
-        _sync_condition = asyncio.Condition()
+    # registered before responding, so concurrent streams are all counted
+    client = _client_address(request)
+    released = _add_poller(client)
+    if released is None:
+        return fastapi.Response(status_code=503, headers={"Retry-After": "1"})
+
+    async def events():
+        nonlocal state, table, names, since
+        try:
+            while not released.done():
+                previous = state
+                state, content = await _wait_effects(
+                    state, table, names, since, released
+                )
+                if table is not None:
+                    table, names = _names_table, len(_names)
+                if since is not None and previous < _Effect._backlog_offs:
+                    # resynced, the client forgets the fragments it holds
+                    since = state
+                yield b"data: " + content + b"\n\n"
+        finally:
+            done()
+
+    stream = events()
+    # also removed should the stream never be started
+    done = weakref.finalize(stream, _remove_poller, client, released)
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache, no-store, must-revalidate"},
+    )
 
-    async with _sync_condition:
-        if state >= _Effect._backlog_offs + len(_Effect._backlog):
-            await _sync_condition.wait()
+
+def _gzip(content: bytes) -> Optional[bytes]:
+    if len(content) < GZIP_MIN_SIZE:
+        return None
+    return gzip.compress(content, compresslevel=GZIP_LEVEL)
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    # "gzip;q=0" refuses it, "*" accepts any coding not listed
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        name, *params = coding.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+def _compressed(
+    request: Optional[fastapi.Request],
+    content: bytes,
+    media_type: str,
+    gzipped: Optional[bytes] = None,
+) -> fastapi.Response:
+    """
+    Response with content gzipped, if the client accepts it and it's large
+    enough. gzipped may supply content already compressed with _gzip().
+    """
+    accepts = request is not None and _accepts_gzip(
+        request.headers.get("accept-encoding", "")
+    )
+    if accepts and gzipped is None:
+        gzipped = _gzip(content)
+
+    if not accepts or gzipped is None:
+        return fastapi.Response(
+            content=content, media_type=media_type, headers={"Vary": "Accept-Encoding"}
+        )
+
+    return fastapi.Response(
+        content=gzipped,
+        media_type=media_type,
+        headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+    )
+
+
+def _validated(
+    request: Optional[fastapi.Request],
+    content: bytes,
+    media_type: str,
+    gzipped: Optional[bytes],
+    etag: str,
+    cache_control: str,
+) -> fastapi.Response:
+    """
+    Response as _compressed(), tagged with etag, or 304 if the client already
+    holds it. The tag is distinct per content encoding, so a cache revalidating
+    one encoding is never handed the other.
+    """
+    response = _compressed(request, content, media_type, gzipped=gzipped)
+    encoding = response.headers.get("content-encoding")
+    etag = f'"{etag}-{encoding}"' if encoding else f'"{etag}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if request is not None and request.headers.get("if-none-match") == etag:
+        return fastapi.Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return response
+
+
+def _client_address(connection: fastapi.requests.HTTPConnection) -> str:
+    return connection.client.host if connection.client is not None else ""
+
+
+# futures releasing the waiting long polls, streams and sockets of each client,
+# oldest first
+_pollers = {}
+_poller_count = 0
+
+
+def _add_poller(client: str) -> Optional[asyncio.Future]:
+    """
+    Registers a waiting long poll, stream or socket of client, returning a
+    future resolved should it be released for a newer one of the client, or
+    None if it's turned away. Checking and registering is one step, so
+    concurrent newcomers can't all pass the check.
+    """
+    global _poller_count
+
+    waiting = _pollers.setdefault(client, deque())
+    if len(waiting) >= MAX_POLLERS_PER_CLIENT or (
+        waiting and _poller_count >= MAX_POLLERS
+    ):
+        # Most likely a stream or socket left half-open by a client gone to
+        # sleep, which heartbeats don't free as writes to it keep succeeding
+        # until TCP gives up minutes later. Released long polls are told to
+        # retry later rather than polling again at once.
+        oldest = waiting.popleft()
+        _poller_count -= 1
+        if not oldest.done():
+            oldest.set_result(None)
+    elif _poller_count >= MAX_POLLERS:
+        if not waiting:
+            del _pollers[client]
+        return None
+
+    released = asyncio.get_running_loop().create_future()
+    waiting.append(released)
+    _poller_count += 1
+    return released
+
+
+def _remove_poller(client: str, released: asyncio.Future) -> None:
+    global _poller_count
+
+    waiting = _pollers.get(client)
+    # unless already released
+    if waiting is not None and released in waiting:
+        waiting.remove(released)
+        _poller_count -= 1
+        if not waiting:
+            del _pollers[client]
+
+
+@contextlib.contextmanager
+def _poller(client: str):
+    """
+    Registers a waiting long poll or socket for as long as it waits, yielding
+    the future releasing it, or None if it's turned away.
+    """
+    released = _add_poller(client)
+    try:
+        yield released
+    finally:
+        if released is not None:
+            _remove_poller(client, released)
+
+
+# The compact wire format refers to keys and attribute names by their position
+# in a table that clients hold a copy of, sending only the names a client
+# hasn't seen yet: [state, time, resync, table, base, [names from base], key,
+# index, html, ...] where attribute names are given as ~position in place of
+# the child index (list operations are sent as they are).
+_names = []
+_name_refs = {}
+_names_table = 0
+
+
+def _intern(name: Optional[str]) -> int:
+    ref = _name_refs.get(name)
+    if ref is None:
+        ref = _name_refs[name] = len(_names)
+        _names.append(name)
+    return ref
+
+
+def _restart_names() -> None:
+    global _names, _name_refs, _names_table
+
+    _names = []
+    _name_refs = {}
+    _names_table += 1
+    # positions in the compact encodings refer to the old table
+    _Effect._encoded = {}
+
+
+async def _wait_effects(
+    state: int,
+    table: Optional[int] = None,
+    names: int = 0,
+    since: Optional[int] = None,
+    released: Optional[asyncio.Future] = None,
+) -> Tuple[int, bytes]:
+    """
+    Waits until there are updates beyond state, returning the new state and
+    the JSON encoded response. Returns without updates, as a heartbeat, after
+    POLL_TIMEOUT or once released. Given the table, and how many of its names
+    the client holds, the response uses the compact wire format. Given the
+    state since which the client holds the fragments it was sent, fragments
+    may be sent as splices of those.
+    """
+    global _generation
 
     if state >= _Effect._backlog_offs + len(_Effect._backlog):
-        updates = []
+        if _generation is None:
+            _generation = asyncio.get_running_loop().create_future()
+        # shielded, a cancelled waiter mustn't cancel it for everyone else
+        generation = asyncio.shield(_generation)
+        waits = [generation] if released is None else [generation, released]
+        await asyncio.wait(
+            waits, timeout=POLL_TIMEOUT, return_when=asyncio.FIRST_COMPLETED
+        )
+        generation.cancel()
+
+    current_state = _Effect._backlog_offs + len(_Effect._backlog)
+    resync = state < _Effect._backlog_offs
+    if resync:
+        span = (None, current_state)
     else:
-        updates = [
-            u
-            for updates in itertools.islice(
-                _Effect._backlog, state - _Effect._backlog_offs, None
+        span = (min(state, current_state), current_state)
+    compact = table is not None
+
+    # clients are told to forget the fragments they hold on resyncing, so
+    # clients with the same diffs usable share the encoded updates too
+    usable = None
+    if since is not None and not resync:
+        bases = _Effect._diff_bases.get(span)
+        if bases is None:
+            bases = _Effect._diff_bases[span] = sorted(
+                u[4][0]
+                for entry in itertools.islice(
+                    _Effect._backlog, span[0] - _Effect._backlog_offs, None
+                )
+                for u in entry
+                if u[4] is not None
             )
-            for u in updates
-        ]
+        usable = bisect.bisect_left(bases, since)
+
+    # every client polling from the same state shares the encoded updates
+    encoded = _Effect._encoded.get((span, compact, usable))
+    if encoded is None:
+        if resync:
+            # fallen off the backlog, the top level effects cover everything
+            # the client could hold
+            updates = [
+                (e.key, e.index, e.html)
+                for body in _pages
+                for e in body.children
+                if e.key is not None
+            ]
+        else:
+            updates = _Effect.coalesce(
+                list(
+                    itertools.islice(
+                        _Effect._backlog, span[0] - _Effect._backlog_offs, None
+                    )
+                ),
+                span[0],
+                since,
+            )
+        if compact:
+            if len(_names) > NAMES_LIMIT:
+                _restart_names()
+            updates = [
+                ref
+                for key, index, html in updates
+                for ref in (
+                    _intern(key),
+                    ~_intern(index) if isinstance(index, str) else index,
+                    html,
+                )
+            ]
+        encoded = json.dumps(
+            updates, ensure_ascii=False, separators=(",", ":")
+        ).encode()
+        _Effect._encoded[(span, compact, usable)] = encoded
 
     current_time = int(time.time() * 1000)
-    data = dict(
-        state=_Effect._backlog_offs + len(_Effect._backlog),
-        updates=updates,
-        time=current_time,
+    if not compact:
+        return current_state, b"".join(
+            [
+                b'{"state":%d,"updates":' % current_state,
+                encoded,
+                b',"time":%d' % current_time,
+                b',"resync":true}' if resync else b"}",
+            ]
+        )
+
+    # a client holding another table, or more names than it could, starts over
+    base = names if table == _names_table and names <= len(_names) else 0
+    return current_state, b"".join(
+        [
+            b"[%d,%d,%d,%d,%d,"
+            % (current_state, current_time, resync, _names_table, base),
+            json.dumps(
+                _names[base:], ensure_ascii=False, separators=(",", ":")
+            ).encode(),
+            b"," + encoded[1:-1] if len(encoded) > 2 else b"",
+            b"]",
+        ]
     )
-    response = JSONResponse(content=data)
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = "0"
 
-    return response
+
+# the client runtime is the same for every page, minified once and cached by
+# clients until it changes
+_runtime = js.minify(
+    js.runtime(
+        CALLBACK_URL,
+        EFFECTS_URL,
+        EFFECTS_STREAM_URL,
+        WEBSOCKET_URL,
+        LOG_URL,
+    )
+).encode()
+_runtime_version = hashlib.sha1(_runtime).hexdigest()[:12]
+_runtime_gzipped = _gzip(_runtime)
+
+
+@router.get(RUNTIME_URL)
+async def _runtime_script(request: fastapi.Request):
+    return _validated(
+        request,
+        _runtime,
+        "application/javascript",
+        _runtime_gzipped,
+        _runtime_version,
+        "public, max-age=31536000, immutable",
+    )
 
 
 @router.post(LOG_URL)
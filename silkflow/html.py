@@ -61,6 +61,16 @@ audio = _factory("audio")
 video = _factory("video")
 source = _factory("source", allow_children=False)
 
+# SVG
+svg = _factory("svg")
+g = _factory("g")
+path = _factory("path", allow_children=False)
+polyline = _factory("polyline", allow_children=False)
+line = _factory("line", allow_children=False)
+rect = _factory("rect", allow_children=False)
+circle = _factory("circle", allow_children=False)
+text = _factory("text")
+
 # Table content
 caption = _factory("caption")
 col = _factory("col")
@@ -66,29 +66,248 @@ def offset_manager(window_len):
     """
 
 
-def effects_loop(session_id, effects_url, initial_state, time_manager):
+def effects_loop(
+    session, effects_url, stream_url, socket_url, initial_state, time_manager, diff_min_size
+):
     return f"""
         (function(timeOffsetManager, initial_state, effects_url) {{
             var state = {initial_state};
             var tempContainer = document.createElement('div');
 
-            var replaceKey = function (key, index, newHtml) {{
-                var parent = document.querySelector('[key="' + key + '"]');
-                if (!parent) {{ return; }}               
-                if (typeof index === 'string') {{
-                    parent.setAttribute(index, newHtml);
-                }} else {{
-                    var child = parent.childNodes[index];
-                    if (!child) {{ return; }}
-                    tempContainer.innerHTML = newHtml;
-                    var newElement = tempContainer.firstChild;
-                    parent.replaceChild(newElement, child);
+            // keyed elements, indexed as fragments are inserted rather than
+            // searching the whole document for every update
+            var keyed = {{}};
+
+            // calls visit on node and every keyed element below it
+            function eachKeyed(node, visit) {{
+                if (node.nodeType !== 1) {{ return; }}
+                if (node.hasAttribute('key')) {{ visit(node); }}
+                var nested = node.querySelectorAll('[key]');
+                for (var i = 0; i < nested.length; i++) {{ visit(nested[i]); }}
+            }}
+
+            function indexKey(element) {{ keyed[element.getAttribute('key')] = element; }}
+
+            // fragments sent since the given state, for splices to be applied to
+            var since = state;
+            var fragments = {{}};
+
+            function forgetKey(element) {{
+                var key = element.getAttribute('key');
+                delete keyed[key];
+                delete fragments[key];
+            }}
+
+            function findKey(key) {{
+                var element = keyed[key];
+                if (!element) {{
+                    element = document.querySelector('[key="' + key + '"]');
+                    if (element) {{ keyed[key] = element; }}
                 }}
+                return element;
+            }}
+
+            var svgNamespace = 'http://www.w3.org/2000/svg';
+
+            // fragments are parsed within the elements their parent needs, as
+            // svg elements rather than unknown html ones, and as rows and
+            // cells rather than the bare text left of them outside a table
+            var wrappers = {{
+                svg: ['<svg>', '</svg>', 1],
+                TABLE: ['<table>', '</table>', 1],
+                THEAD: ['<table><thead>', '</thead></table>', 2],
+                TBODY: ['<table><tbody>', '</tbody></table>', 2],
+                TFOOT: ['<table><tfoot>', '</tfoot></table>', 2],
+                TR: ['<table><tbody><tr>', '</tr></tbody></table>', 3]
             }};
 
+            function contextOf(parent) {{
+                if (!parent) {{ return ''; }}
+                if (parent.namespaceURI === svgNamespace) {{ return 'svg'; }}
+                return wrappers.hasOwnProperty(parent.tagName) ? parent.tagName : '';
+            }}
+
+            // parses every fragment of a context at once, split by markers
+            function parseFragments(fragments, context) {{
+                if (fragments.length === 0) {{ return []; }}
+                var joined = fragments.join('<!--silkflow-->');
+                var container = tempContainer;
+                var wrapper = wrappers[context];
+                if (wrapper) {{
+                    tempContainer.innerHTML = wrapper[0] + joined + wrapper[1];
+                    for (var depth = 0; depth < wrapper[2]; depth++) {{
+                        container = container.firstChild;
+                    }}
+                }} else {{
+                    tempContainer.innerHTML = joined;
+                }}
+                var children = Array.prototype.slice.call(container.childNodes);
+                var nodes = [];
+                var current = null;
+                children.forEach(function(child) {{
+                    if (child.nodeType === 8 && child.data === 'silkflow') {{
+                        nodes.push(current || document.createTextNode(''));
+                        current = null;
+                    }} else if (current === null) {{
+                        current = child;
+                    }}
+                }});
+                nodes.push(current || document.createTextNode(''));
+                return nodes;
+            }}
+
+            // fragments parsed a context at a time, returned in order
+            function parseAll(html, contexts) {{
+                var grouped = {{}};
+                contexts.forEach(function(context, i) {{
+                    (grouped[context] = grouped[context] || []).push(html[i]);
+                }});
+                var parsed = {{}};
+                var next = {{}};
+                for (var context in grouped) {{
+                    parsed[context] = parseFragments(grouped[context], context);
+                    next[context] = 0;
+                }}
+                return contexts.map(function(context) {{
+                    return parsed[context][next[context]++];
+                }});
+            }}
+
+            // the compact wire format refers to keys and attribute names by
+            // their position in a table, sent a name at a time as it grows
+            var table = -1;
+            var names = [];
+
+            function stateQuery() {{
+                return "&state=" + state + "&since=" + since + "&table=" + table + "&names=" + names.length;
+            }}
+
+            // [state, time, resync, table, base, [names], key, index, html, ...]
+            function decode(data) {{
+                table = data[3];
+                names.length = data[4];
+                names.push.apply(names, data[5]);
+                var updates = [];
+                for (var i = 6; i < data.length; i += 3) {{
+                    var index = data[i + 1];
+                    updates.push([names[data[i]], index < 0 ? names[~index] : index, data[i + 2]]);
+                }}
+                return {{state: data[0], time: data[1], resync: data[2] === 1, updates: updates}};
+            }}
+
+            // child replacements, and list and stream additions, carry a
+            // fragment to parse
+            function carriesFragment(item) {{
+                if (typeof item[1] === 'string') {{ return false; }}
+                return typeof item[1] === 'number' || (item[1][0] !== '-' && item[1][0] !== 'm');
+            }}
+
+            // ['-', position], ['+', position] or ['m', from, to] on a list,
+            // ['>', maxlen] or ['<', maxlen] on a stream
+            function applyListOp(parent, op, node) {{
+                // positions shift, the fragments held for them no longer apply
+                delete fragments[parent.getAttribute('key')];
+                if (op[0] === '>' || op[0] === '<') {{
+                    parent.insertBefore(node, op[0] === '>' ? null : parent.firstChild);
+                    eachKeyed(node, indexKey);
+                    // trimmed from the other end
+                    while (op[1] !== null && parent.childNodes.length > op[1]) {{
+                        var trimmed = op[0] === '>' ? parent.firstChild : parent.lastChild;
+                        eachKeyed(trimmed, forgetKey);
+                        parent.removeChild(trimmed);
+                    }}
+                    return;
+                }}
+                if (op[0] === '+') {{
+                    parent.insertBefore(node, parent.childNodes[op[1]] || null);
+                    eachKeyed(node, indexKey);
+                    return;
+                }}
+                var child = parent.childNodes[op[1]];
+                if (!child) {{ return; }}
+                parent.removeChild(child);
+                if (op[0] === 'm') {{
+                    parent.insertBefore(child, parent.childNodes[op[2]] || null);
+                }} else {{
+                    eachKeyed(child, forgetKey);
+                }}
+            }}
+
+            function applyEffects(data) {{
+                if (data) {{
+                    if (Array.isArray(data)) {{
+                        data = decode(data);
+                    }}
+                    state = data.state;
+                    if (data.resync) {{
+                        since = state;
+                        fragments = {{}};
+                    }}
+                    var updates = [];
+                    var html = [];
+                    var contexts = [];
+                    for (var i = 0; i < data.updates.length; i++) {{
+                        var item = data.updates[i];
+                        var parent = findKey(item[0]);
+                        if (!carriesFragment(item)) {{
+                            updates.push(item);
+                            continue;
+                        }}
+                        var fragment = item[2];
+                        if (typeof fragment !== 'string') {{
+                            // [prefix, suffix, middle] splicing the fragment held
+                            var held = (fragments[item[0]] || {{}})[item[1]];
+                            if (held === undefined) {{
+                                // the backlog is shared by every page, those of
+                                // others are never held
+                                if (!parent) {{ continue; }}
+                                // never expected, but start over rather than diverge
+                                window.location.reload();
+                                return;
+                            }}
+                            fragment = held.slice(0, fragment[0]) + fragment[2] + held.slice(held.length - fragment[1]);
+                        }}
+                        updates.push(item);
+                        html.push(fragment);
+                        contexts.push(contextOf(parent));
+                    }}
+                    var nodes = parseAll(html, contexts);
+                    var next = 0;
+                    updates.forEach(function(item) {{
+                        var parent = findKey(item[0]);
+                        if (typeof item[1] === 'string') {{
+                            if (parent) {{ parent.setAttribute(item[1], item[2]); }}
+                            return;
+                        }}
+                        var fragment = carriesFragment(item) ? html[next] : null;
+                        var node = carriesFragment(item) ? nodes[next++] : null;
+                        if (typeof item[1] !== 'number') {{
+                            if (parent) {{ applyListOp(parent, item[1], node); }}
+                            return;
+                        }}
+                        var child = parent && parent.childNodes[item[1]];
+                        if (!child) {{ return; }}
+                        eachKeyed(child, forgetKey);
+                        parent.replaceChild(node, child);
+                        eachKeyed(node, indexKey);
+                        if (fragment.length >= {diff_min_size}) {{
+                            (fragments[item[0]] = fragments[item[0]] || {{}})[item[1]] = fragment;
+                        }}
+                    }});
+                    tempContainer.innerHTML = '';
+                    if (data.time !== undefined) {{
+                        timeOffsetManager.addTime(data.time);
+                    }}
+                }}
+            }}
+
+            // back off exponentially while the server is unreachable or busy
+            var retryDelay = 0;
+            var maxRetryDelay = 30000;
+
             function pollEffects() {{
                 var xhr = new XMLHttpRequest();
-                var url = "{effects_url}?session={session_id}&state=" + state;
+                var url = "{effects_url}?session=" + {session} + stateQuery();
                 xhr.open('GET', url, true);
                 xhr.setRequestHeader('Content-Type', 'application/json');
                 xhr.setRequestHeader('Cache-Control', 'no-cache, no-store, must-revalidate');
@@ -97,36 +316,114 @@ def effects_loop(session_id, effects_url, initial_state, time_manager):
                 xhr.onreadystatechange = function() {{
                     if (xhr.readyState === 4) {{
                         if (xhr.status === 200) {{
+                            retryDelay = 0;
                             var redirectUrl = xhr.getResponseHeader("X-Redirect-URL");
                             if (redirectUrl) {{
                                 window.location.href = redirectUrl;
                             }} else {{
-                                var data = JSON.parse(xhr.responseText);
-                                if (data) {{
-                                    state = data.state;
-                                    data.updates.forEach(function(item) {{
-                                        replaceKey(item[0], item[1], item[2]);
-                                    }});
-                                    if (data.time !== undefined) {{
-                                        timeOffsetManager.addTime(data.time);
-                                    }}
-                                }}
+                                applyEffects(JSON.parse(xhr.responseText));
                             }}
+                        }} else {{
+                            backOff();
                         }}
-                        setTimeout(pollEffects, 0);
+                        setTimeout(pollEffects, retryDelay);
                     }}
                 }};
                 xhr.send();
             }}
 
-            pollEffects();
+            function backOff() {{
+                retryDelay = Math.min(Math.max(2 * retryDelay, 500), maxRetryDelay);
+                return retryDelay;
+            }}
+
+            // a single long lived stream where supported, long polling otherwise
+            function streamEffects() {{
+                var source = new EventSource("{stream_url}?session=" + {session} + stateQuery());
+                var opened = false;
+                source.onopen = function() {{
+                    opened = true;
+                }};
+                source.onmessage = function(e) {{
+                    retryDelay = 0;
+                    applyEffects(JSON.parse(e.data));
+                }};
+                source.onerror = function() {{
+                    source.close();
+                    if (opened) {{
+                        // dropped, streaming again picks up from the last state
+                        setTimeout(streamEffects, backOff());
+                    }} else {{
+                        // polling picks up from the last state, or redirects
+                        pollEffects();
+                    }}
+                }};
+            }}
+
+            function fallback() {{
+                if (window.EventSource) {{
+                    streamEffects();
+                }} else {{
+                    pollEffects();
+                }}
+            }}
+
+            // a websocket also carries callbacks, saving a round trip per tap
+            var socket = null;
+            function socketEffects() {{
+                var scheme = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
+                var ws = new WebSocket(scheme + window.location.host + "{socket_url}?session=" + {session} + stateQuery());
+                var opened = false;
+                ws.onopen = function() {{
+                    opened = true;
+                    socket = ws;
+                }};
+                ws.onmessage = function(e) {{
+                    retryDelay = 0;
+                    var data = JSON.parse(e.data);
+                    if (data.redirect) {{
+                        window.location.href = data.redirect;
+                    }} else {{
+                        applyEffects(data);
+                    }}
+                }};
+                // also follows any error
+                ws.onclose = function(e) {{
+                    socket = null;
+                    if (opened || e.code === 1013) {{
+                        // dropped or busy, only a socket never opened falls back
+                        setTimeout(socketEffects, backOff());
+                    }} else {{
+                        fallback();
+                    }}
+                }};
+            }}
+
+            if (window.WebSocket) {{
+                socketEffects();
+            }} else {{
+                fallback();
+            }}
+
+            return {{
+                send: function(message) {{
+                    if (socket && socket.readyState === 1) {{
+                        socket.send(JSON.stringify(message));
+                        return true;
+                    }}
+                    return false;
+                }}
+            }};
         }})({time_manager})
     """
 
 
-def callback_handlers(callback_url, offset_manager):
+def callback_handlers(session, callback_url, offset_manager, effects_loop):
     return f"""
         pythonImpl = function (id, event, timestamp) {{
+            if ({effects_loop}.send({{id: id, event: {{time: timestamp}}}})) {{
+                return;
+            }}
             var xhr = new XMLHttpRequest();
             xhr.open('POST', "{callback_url}", true);
             xhr.setRequestHeader('Content-Type', 'application/json');
@@ -141,6 +438,7 @@ def callback_handlers(callback_url, offset_manager):
             xhr.send(JSON.stringify({{
                 id: id,
                 event: {{time: timestamp}},
+                session: {session},
             }}));
         }};
 
@@ -211,18 +509,40 @@ def callback_handlers(callback_url, offset_manager):
     """
 
 
-def render(body, session_id, callback_url, effects_url, log_url, initial_state, head_elems=[]):
-    return html.html(
-        html.head(
-            html.script(f"""
-                var offsetManager = {offset_manager(5)};
+def runtime(callback_url, effects_url, stream_url, socket_url, log_url):
+    """
+    The client runtime. It's the same for every page, which pass their session,
+    initial state and the size from which fragments are diffed in a
+    silkflowConfig global.
+    """
+    return f"""
+        var offsetManager = {offset_manager(5)};
 
-                {effects_loop(session_id, effects_url, initial_state, "offsetManager")}
+        var effectsLoop = {effects_loop("silkflowConfig.session", effects_url, stream_url, socket_url, "silkflowConfig.state", "offsetManager", "silkflowConfig.diffMinSize")};
+
+        {callback_handlers("silkflowConfig.session", callback_url, "offsetManager", "effectsLoop")};
+
+        {console_log(log_url)};
+    """
 
-                {callback_handlers(callback_url, "offsetManager")};
 
-                {console_log(log_url)};
-            """),
+def minify(script):
+    # statements are kept on their own lines, so semicolon insertion still holds
+    return "\n".join(
+        line
+        for line in (line.strip() for line in script.splitlines())
+        if line and not line.startswith("//")
+    )
+
+
+def render(body, session_id, initial_state, diff_min_size, runtime_url, head_elems=[]):
+    return html.html(
+        html.head(
+            html.script(
+                f'var silkflowConfig = {{session: "{session_id}", state: {initial_state}, '
+                f"diffMinSize: {diff_min_size}}};"
+            ),
+            html.script(src=runtime_url),
             *head_elems,
         ),
         *body,
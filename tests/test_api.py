@@ -2,35 +2,52 @@ import asyncio
 from bs4 import BeautifulSoup
 from collections import deque
 import fastapi
+from fastapi.testclient import TestClient
+from fastapi import WebSocketDisconnect
 import httpx
+import json
 import pytest
 
 import silkflow
 
 
-async def _test_effects(client, state, expected_state, expected_updates):
-    response, _ = await asyncio.gather(
-        client.get(f"/effects?session={silkflow.core._session_id}&state={state}"), silkflow.sync_effects()
-    )
+async def _test_effects(
+    client, state, expected_state, expected_updates, resync=False
+):
+    url = f"/effects?session={silkflow.core._session_id}&state={state}"
+    # with nothing new, the poll is held open until a heartbeat after POLL_TIMEOUT
+    response, _ = await asyncio.gather(client.get(url), silkflow.sync_effects())
     assert response.status_code == 200
     result = response.json()
-    assert result == {
+    expected = {
         "state": expected_state,
         "updates": expected_updates,
         "time": result["time"],
     }
+    if resync:
+        expected["resync"] = True
+    assert result == expected
 
 
-def _init_core():
+def _init_core(monkeypatch):
     silkflow.core._Effect._stale_effects = set()
     silkflow.core._Effect._backlog = deque()
     silkflow.core._Effect._backlog_offs = 0
-    silkflow.core._sync_condition = None
+    silkflow.core._Effect._backlog_bytes = 0
+    silkflow.core._Effect._encoded = {}
+    silkflow.core._pages = []
+    silkflow.core._generation = None
+    silkflow.core._pollers = {}
+    silkflow.core._poller_count = 0
+    silkflow.core._names = []
+    silkflow.core._name_refs = {}
+    silkflow.core._names_table = 0
+    monkeypatch.setattr(silkflow.core, "POLL_TIMEOUT", 0.1)
 
 
 @pytest.mark.asyncio
-async def test_get():
-    _init_core()
+async def test_get(monkeypatch):
+    _init_core(monkeypatch)
 
     app = fastapi.FastAPI()
     app.include_router(silkflow.router)
@@ -73,17 +90,32 @@ async def test_get():
         # This is typical of async loops updating state as opposed to via callbacks
         await silkflow.sync_effects()
 
-        await _test_effects(client, 0, 2, [[key, 0, "new str"], [key, 0, "str2"]])
+        # superseded updates are coalesced
+        await _test_effects(client, 0, 2, [[key, 0, "str2"]])
         await _test_effects(client, 1, 2, [[key, 0, "str2"]])
         await _test_effects(client, 2, 2, [])
 
-        # blow out core.MAX_UPDATES
-        for i in range(2, silkflow.core.BACKLOG_LEN + 3):
+        # blow out core.BACKLOG_BYTES
+        monkeypatch.setattr(silkflow.core, "BACKLOG_BYTES", 40)
+        for i in range(2, 12):
             c1.value = f"new str {i}"
             await _test_effects(client, i, i + 1, [[key, 0, f"new str {i}"]])
-
-        # if we've fallen off the cached effects, we expect a redirect
-        response = await client.get(f"/effects?session={silkflow.core._session_id}&state=0")
+        assert silkflow.core._Effect._backlog_offs > 0
+        assert silkflow.core._Effect._backlog_bytes <= 40
+
+        # if we've fallen off the cached effects, we're sent the top level
+        # effects in full
+        body_key = soup.find("body")["key"]
+        await _test_effects(
+            client,
+            0,
+            12,
+            [[body_key, 0, f'<div key="{key}">new str 11</div>']],
+            resync=True,
+        )
+
+        # a new session however requires a reload
+        response = await client.get(f"/effects?session=stale&state=12")
         assert response.status_code == 200
         x_redirect_url = response.headers.get("X-Redirect-URL")
         assert x_redirect_url == "/"
@@ -92,8 +124,8 @@ async def test_get():
 
 
 @pytest.mark.asyncio
-async def test_attribute():
-    _init_core()
+async def test_attribute(monkeypatch):
+    _init_core(monkeypatch)
 
     app = fastapi.FastAPI()
     app.include_router(silkflow.router)
@@ -144,3 +176,645 @@ async def test_attribute():
 
         await _test_effects(client, 0, 1, [[key, "attr", "new_value"]])
         await _test_effects(client, 1, 1, [])
+
+
+@pytest.mark.asyncio
+async def test_compact(monkeypatch):
+    _init_core(monkeypatch)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    c1 = silkflow.Signal(0)
+    c2 = silkflow.Signal(0)
+
+    @silkflow.effect
+    def count():
+        return str(c2.value)
+
+    @silkflow.effect
+    def attr():
+        return str(c1.value)
+
+    @app.get("/")
+    @silkflow.effect(render=True)
+    def test():
+        return silkflow.html.div(count(), attr=attr())
+
+    async def poll(client, state, table, names):
+        url = (
+            f"/effects?session={silkflow.core._session_id}&state={state}"
+            f"&table={table}&names={names}"
+        )
+        response, _ = await asyncio.gather(client.get(url), silkflow.sync_effects())
+        result = response.json()
+        # the time is second, after the state, then whether resyncing
+        del result[1]
+        return result
+
+    async with httpx.AsyncClient(app=app, base_url="http://test.me") as client:
+        response = await client.get("/")
+        soup = BeautifulSoup(response.text, "html.parser")
+        key = soup.find("div")["key"]
+
+        assert await poll(client, 0, -1, 0) == [0, 0, 0, 0, []]
+
+        c1.value = 1
+        # the names are sent to a client once, attribute names as ~position
+        assert await poll(client, 0, -1, 0) == [1, 0, 0, 0, [key, "attr"], 0, ~1, "1"]
+        c2.value = 2
+        assert await poll(client, 1, 0, 2) == [2, 0, 0, 2, [], 0, 0, "2"]
+        # a client with an unknown table gets the table in full
+        assert await poll(client, 1, 7, 2) == [2, 0, 0, 0, [key, "attr"], 0, 0, "2"]
+        # the plain format is unaffected
+        await _test_effects(client, 1, 2, [[key, 0, "2"]])
+
+        # the table is restarted once it outgrows NAMES_LIMIT
+        monkeypatch.setattr(silkflow.core, "NAMES_LIMIT", 1)
+        c2.value = 3
+        assert await poll(client, 2, 0, 2) == [3, 0, 1, 0, [key], 0, 0, "3"]
+
+
+@pytest.mark.asyncio
+async def test_diff(monkeypatch):
+    _init_core(monkeypatch)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    c1 = silkflow.Signal(0)
+
+    @silkflow.effect
+    def rows():
+        return silkflow.html.table(
+            *(
+                silkflow.html.tr(silkflow.html.td(str(c1.value if i == 7 else i)))
+                for i in range(50)
+            )
+        )
+
+    @app.get("/")
+    @silkflow.effect(render=True)
+    def test():
+        return silkflow.html.div(rows())
+
+    async def poll(client, state, since=None):
+        url = f"/effects?session={silkflow.core._session_id}&state={state}"
+        if since is not None:
+            url += f"&since={since}"
+        response, _ = await asyncio.gather(client.get(url), silkflow.sync_effects())
+        return response.json()["updates"]
+
+    async with httpx.AsyncClient(app=app, base_url="http://test.me") as client:
+        response = await client.get("/")
+        key = BeautifulSoup(response.text, "html.parser").find("div")["key"]
+
+        c1.value = "a"
+        # nothing sent yet to diff against
+        first = await poll(client, 0, since=0)
+        assert first[0][:2] == [key, 0] and isinstance(first[0][2], str)
+
+        c1.value = "bb"
+        await silkflow.sync_effects()
+        full = first[0][2].replace("<td>a</td>", "<td>bb</td>")
+        prefix = first[0][2].index("<td>a</td>") + 4
+        suffix = len(first[0][2]) - prefix - 1
+        assert await poll(client, 1, since=0) == [[key, 0, [prefix, suffix, "bb"]]]
+        # clients without the previous version are sent it whole
+        assert await poll(client, 0, since=0) == [[key, 0, full]]
+        assert await poll(client, 1, since=2) == [[key, 0, full]]
+        assert await poll(client, 1) == [[key, 0, full]]
+
+
+@pytest.mark.asyncio
+async def test_batch(monkeypatch):
+    _init_core(monkeypatch)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    c1 = silkflow.Signal("a")
+    c2 = silkflow.Signal("b")
+
+    @silkflow.effect
+    def the_str():
+        return c1.value + c2.value
+
+    @app.get("/")
+    @silkflow.effect(render=True)
+    def test():
+        return silkflow.html.div(the_str())
+
+    @silkflow.batch()
+    def update(i):
+        c1.value = f"a{i}"
+        c2.value = f"b{i}"
+
+    async with httpx.AsyncClient(app=app, base_url="http://test.me") as client:
+        response = await client.get("/")
+        soup = BeautifulSoup(response.text, "html.parser")
+        key = soup.find("div")["key"]
+
+        with silkflow.batch():
+            c1.value = "x"
+            with silkflow.batch():
+                c2.value = "y"
+            # nothing is flushed until the outermost batch exits
+            assert len(silkflow.core._Effect._stale_effects) == 0
+            assert len(silkflow.core._Effect._backlog) == 0
+
+        # a single backlog entry carrying the combined update
+        assert len(silkflow.core._Effect._backlog) == 1
+        await _test_effects(client, 0, 1, [[key, 0, "xy"]])
+
+        update(1)
+        assert len(silkflow.core._Effect._backlog) == 2
+        await _test_effects(client, 1, 2, [[key, 0, "a1b1"]])
+
+        # a body raising publishes nothing, its writes go with the next sync
+        with pytest.raises(ValueError):
+            with silkflow.batch():
+                c1.value = "half"
+                raise ValueError
+        assert len(silkflow.core._Effect._backlog) == 2
+        await silkflow.sync_effects()
+        await _test_effects(client, 2, 3, [[key, 0, "halfb1"]])
+
+        # writes off the event loop wake waiters through it
+        monkeypatch.setattr(silkflow.core, "POLL_TIMEOUT", 10)
+        url = f"/effects?session={silkflow.core._session_id}&state=3"
+        waiting = asyncio.create_task(client.get(url))
+        await asyncio.sleep(0.05)
+        await asyncio.to_thread(update, 2)
+        response = await asyncio.wait_for(waiting, 1)
+        assert response.json()["updates"] == [[key, 0, "a2b2"]]
+
+
+@pytest.mark.asyncio
+async def test_unchanged(monkeypatch):
+    _init_core(monkeypatch)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    c1 = silkflow.Signal(1.0)
+
+    @silkflow.effect
+    def rounded():
+        return str(round(c1.value))
+
+    @app.get("/")
+    @silkflow.effect(render=True)
+    def test():
+        return silkflow.html.div(rounded())
+
+    async with httpx.AsyncClient(app=app, base_url="http://test.me") as client:
+        response = await client.get("/")
+        soup = BeautifulSoup(response.text, "html.parser")
+        key = soup.find("div")["key"]
+
+        # re-renders to the same html, so nothing is published
+        c1.value = 1.2
+        assert len(silkflow.core._Effect._stale_effects) == 1
+        await _test_effects(client, 0, 0, [])
+        assert len(silkflow.core._Effect._backlog) == 0
+
+        c1.value = 2.2
+        await _test_effects(client, 0, 1, [[key, 0, "2"]])
+
+
+@pytest.mark.asyncio
+async def test_callback(monkeypatch):
+    _init_core(monkeypatch)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    pressed = []
+
+    @silkflow.callback
+    def press(event):
+        pressed.append(event)
+
+    id = press.split('"')[1]
+
+    async with httpx.AsyncClient(app=app, base_url="http://test.me") as client:
+        body = dict(id=id, event=dict(time=1), session=silkflow.core._session_id)
+        response = await client.post("/callback", json=body)
+        assert response.status_code == 200
+        assert "X-Redirect-URL" not in response.headers
+        assert pressed == [dict(time=1)]
+
+        # ids from a previous session may belong to another callback
+        body["session"] = "stale"
+        response = await client.post("/callback", json=body)
+        assert response.headers.get("X-Redirect-URL") == "/"
+        assert len(pressed) == 1
+
+
+@pytest.mark.asyncio
+async def test_stream(monkeypatch):
+    _init_core(monkeypatch)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    c1 = silkflow.Signal("str")
+
+    @silkflow.effect
+    def the_str():
+        return c1.value
+
+    @app.get("/")
+    @silkflow.effect(render=True)
+    def test():
+        return silkflow.html.div(the_str())
+
+    async with httpx.AsyncClient(app=app, base_url="http://test.me") as client:
+        response = await client.get("/")
+        soup = BeautifulSoup(response.text, "html.parser")
+        key = soup.find("div")["key"]
+
+    request = fastapi.Request(dict(type="http", client=("127.0.0.1", 1234)))
+    response = await silkflow.core._effects_stream(
+        request, session=silkflow.core._session_id, state=0
+    )
+    assert response.media_type == "text/event-stream"
+    events = response.body_iterator
+
+    # each backlog entry arrives as an event on the one response
+    for i in range(3):
+        c1.value = f"str {i}"
+        event, _ = await asyncio.gather(events.__anext__(), silkflow.sync_effects())
+        event = event.decode()
+        assert event.startswith("data: ") and event.endswith("\n\n")
+        data = json.loads(event[len("data: ") :])
+        assert data["state"] == i + 1
+        assert data["updates"] == [[key, 0, f"str {i}"]]
+
+    await events.aclose()
+
+
+def test_websocket(monkeypatch):
+    _init_core(monkeypatch)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    state = silkflow.Signal(False)
+
+    @silkflow.effect
+    def pressed():
+        return "On" if state.value else "Off"
+
+    @silkflow.callback
+    def toggle(_):
+        state.value = not state.value
+
+    id = toggle.split('"')[1]
+
+    @app.get("/")
+    @silkflow.effect(render=True)
+    def test():
+        return silkflow.html.div(pressed())
+
+    with TestClient(app) as client:
+        response = client.get("/")
+        soup = BeautifulSoup(response.text, "html.parser")
+        key = soup.find("div")["key"]
+
+        url = f"/ws?session={silkflow.core._session_id}&state=0"
+        with client.websocket_connect(url) as websocket:
+            # callbacks go up, effects come down
+            websocket.send_json(dict(id=id, event=dict(time=1)))
+            data = websocket.receive_json()
+            assert data["state"] == 1
+            assert data["updates"] == [[key, 0, "On"]]
+
+            websocket.send_json(dict(id=id, event=dict(time=2)))
+            data = websocket.receive_json()
+            assert data["state"] == 2
+            assert data["updates"] == [[key, 0, "Off"]]
+
+            websocket.send_json(dict(id="unknown", event=dict(time=3)))
+            assert websocket.receive_json() == {"redirect": "/"}
+
+        with client.websocket_connect("/ws?session=stale&state=0") as websocket:
+            assert websocket.receive_json() == {"redirect": "/"}
+
+        # messages that aren't callbacks close the connection
+        for bad in ['{"event": {"time": 4}}', "[1, 2]", "not json", '{"id": 1}']:
+            with client.websocket_connect(url) as websocket:
+                websocket.send_text(bad)
+                with pytest.raises(WebSocketDisconnect) as closed:
+                    # past any effects sent meanwhile
+                    while True:
+                        websocket.receive_json()
+                assert closed.value.code == 1008
+        assert silkflow.core._poller_count == 0
+
+
+@pytest.mark.asyncio
+async def test_fan_out(monkeypatch):
+    _init_core(monkeypatch)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    c1 = silkflow.Signal("str")
+
+    @silkflow.effect
+    def the_str():
+        return c1.value
+
+    @app.get("/")
+    @silkflow.effect(render=True)
+    def test():
+        return silkflow.html.div(the_str())
+
+    # all from the one test client
+    monkeypatch.setattr(silkflow.core, "MAX_POLLERS_PER_CLIENT", 5)
+    encodes = []
+    dumps = silkflow.core.json.dumps
+    monkeypatch.setattr(
+        silkflow.core.json, "dumps", lambda *a, **k: encodes.append(1) or dumps(*a, **k)
+    )
+
+    async with httpx.AsyncClient(app=app, base_url="http://test.me") as client:
+        response = await client.get("/")
+        soup = BeautifulSoup(response.text, "html.parser")
+        key = soup.find("div")["key"]
+
+        url = f"/effects?session={silkflow.core._session_id}&state=0"
+        c1.value = "new str"
+        *responses, _ = await asyncio.gather(
+            *(client.get(url) for _ in range(5)), silkflow.sync_effects()
+        )
+
+        # encoded once for all pollers
+        assert len(encodes) == 1
+        for response in responses:
+            assert response.json()["updates"] == [[key, 0, "new str"]]
+
+
+@pytest.mark.asyncio
+async def test_generation(monkeypatch):
+    _init_core(monkeypatch)
+
+    c1 = silkflow.Signal("str")
+
+    @silkflow.effect
+    def the_str():
+        return c1.value
+
+    effect = the_str()
+    page = silkflow.html.div(effect)
+    "".join(str(p) for p in page)
+
+    waiters = [
+        asyncio.create_task(silkflow.core._wait_effects(0)) for _ in range(3)
+    ]
+    await asyncio.sleep(0)
+    assert all(not w.done() for w in waiters)
+
+    # a waiter going away doesn't disturb the others
+    waiters[0].cancel()
+    await asyncio.sleep(0)
+    assert not silkflow.core._generation.cancelled()
+
+    c1.value = "new str"
+    await silkflow.sync_effects()
+    assert silkflow.core._generation is None
+
+    for w in waiters[1:]:
+        state, content = await w
+        assert state == 1
+        assert json.loads(content)["updates"] == [[effect.key, 0, "new str"]]
+
+
+@pytest.mark.asyncio
+async def test_poller_limits(monkeypatch):
+    _init_core(monkeypatch)
+    monkeypatch.setattr(silkflow.core, "POLL_TIMEOUT", 10)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    url = f"/effects?session={silkflow.core._session_id}&state=0"
+
+    async with httpx.AsyncClient(app=app, base_url="http://test.me") as client:
+        # a client's newest poll releases its oldest, told to retry later
+        # rather than polling again at once
+        monkeypatch.setattr(silkflow.core, "MAX_POLLERS_PER_CLIENT", 1)
+        first = asyncio.create_task(client.get(url))
+        await asyncio.sleep(0.05)
+        assert not first.done()
+        second = asyncio.create_task(client.get(url))
+        response = await asyncio.wait_for(first, 1)
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+        assert not second.done()
+        assert silkflow.core._poller_count == 1
+
+        # beyond the total, clients with none of their own waiting are turned
+        # away
+        monkeypatch.setattr(silkflow.core, "MAX_POLLERS_PER_CLIENT", 4)
+        monkeypatch.setattr(silkflow.core, "MAX_POLLERS", 1)
+        other = fastapi.Request(dict(type="http", client=("10.0.0.2", 1234)))
+        response = await silkflow.core._effects(
+            other, session=silkflow.core._session_id, state=0
+        )
+        assert response.status_code == 503
+        assert not second.done()
+
+        second.cancel()
+        await asyncio.sleep(0.05)
+        assert silkflow.core._poller_count == 0
+
+    # streams are registered as they're responded to, so a newer one releases
+    # an older one half-open or yet to start
+    monkeypatch.setattr(silkflow.core, "MAX_POLLERS", 256)
+    monkeypatch.setattr(silkflow.core, "MAX_POLLERS_PER_CLIENT", 1)
+    request = fastapi.Request(dict(type="http", client=("10.0.0.3", 1234)))
+    responses = [
+        await silkflow.core._effects_stream(
+            request, session=silkflow.core._session_id, state=0
+        )
+        for _ in range(2)
+    ]
+    assert silkflow.core._poller_count == 1
+    with pytest.raises(StopAsyncIteration):
+        await responses[0].body_iterator.__anext__()
+    # and unregistered even if never started
+    del responses
+    assert silkflow.core._poller_count == 0
+    assert silkflow.core._pollers == {}
+
+
+@pytest.mark.asyncio
+async def test_gzip(monkeypatch):
+    _init_core(monkeypatch)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    c1 = silkflow.Signal("str")
+
+    @silkflow.effect
+    def the_str():
+        return c1.value
+
+    @app.get("/")
+    @silkflow.effect(render=True)
+    def test():
+        return silkflow.html.div(
+            silkflow.html.p("padding " * silkflow.core.GZIP_MIN_SIZE), the_str()
+        )
+
+    async with httpx.AsyncClient(app=app, base_url="http://test.me") as client:
+        response = await client.get("/")
+        assert response.headers["content-encoding"] == "gzip"
+        soup = BeautifulSoup(response.text, "html.parser")
+        key = soup.find("div")["key"]
+
+        # compressed once while the page is unchanged
+        document = test.document
+        response = await client.get("/", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert test.document is document
+
+        response = await client.get("/", headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in response.headers
+        assert BeautifulSoup(response.text, "html.parser").find("div")["key"] == key
+
+        # quality values are honoured, a zero refusing the coding
+        for refused in ["gzip;q=0", "gzip; q=0.0, identity", "*;q=0", "deflate"]:
+            response = await client.get("/", headers={"Accept-Encoding": refused})
+            assert "content-encoding" not in response.headers
+        for accepted in ["gzip;q=0.5", "deflate, GZIP", "*", "br;q=1, *;q=0.1"]:
+            response = await client.get("/", headers={"Accept-Encoding": accepted})
+            assert response.headers["content-encoding"] == "gzip"
+
+        # effects above the threshold are compressed too
+        c1.value = "x" * silkflow.core.GZIP_MIN_SIZE
+        response, _ = await asyncio.gather(
+            client.get(f"/effects?session={silkflow.core._session_id}&state=0"),
+            silkflow.sync_effects(),
+        )
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.json()["updates"] == [[key, 1, c1.value]]
+
+        c1.value = "small"
+        response, _ = await asyncio.gather(
+            client.get(f"/effects?session={silkflow.core._session_id}&state=1"),
+            silkflow.sync_effects(),
+        )
+        assert "content-encoding" not in response.headers
+        assert response.json()["updates"] == [[key, 1, "small"]]
+
+
+@pytest.mark.asyncio
+async def test_runtime(monkeypatch):
+    _init_core(monkeypatch)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    @app.get("/")
+    @silkflow.effect(render=True)
+    def test():
+        return silkflow.html.div("hi")
+
+    # read as pages render, so clients hold what the server splices
+    monkeypatch.setattr(silkflow.core, "DIFF_MIN_SIZE", 128)
+
+    async with httpx.AsyncClient(app=app, base_url="http://test.me") as client:
+        response = await client.get("/")
+        soup = BeautifulSoup(response.text, "html.parser")
+        bootstrap, runtime = soup.head.find_all("script")
+        # only the per page values are inline
+        assert silkflow.core._session_id in bootstrap.text
+        assert "diffMinSize: 128" in bootstrap.text
+        assert len(bootstrap.text) < 100
+        assert runtime.text == ""
+
+        response = await client.get(runtime["src"])
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/javascript")
+        assert "immutable" in response.headers["cache-control"]
+        assert "silkflowConfig.session" in response.text
+        assert "silkflowConfig.diffMinSize" in response.text
+        # fragments are parsed within their parent's context
+        assert "<table><tbody><tr>" in response.text
+        etag = response.headers["etag"]
+
+        response = await client.get(runtime["src"], headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+
+
+@pytest.mark.asyncio
+async def test_etag(monkeypatch):
+    _init_core(monkeypatch)
+
+    app = fastapi.FastAPI()
+    app.include_router(silkflow.router)
+
+    c1 = silkflow.Signal("str")
+
+    @silkflow.effect
+    def the_str():
+        return c1.value
+
+    @app.get("/")
+    @silkflow.effect(render=True)
+    def test():
+        return silkflow.html.div(the_str())
+
+    async with httpx.AsyncClient(app=app, base_url="http://test.me") as client:
+        response = await client.get("/")
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        document = test.document
+
+        response = await client.get("/", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert test.document is document
+
+        # any change to the page's effects invalidates the document
+        c1.value = "new str"
+        response = await client.get("/", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert BeautifulSoup(response.text, "html.parser").find("div").text == "new str"
+        etag = response.headers["etag"]
+
+        # as does a new backlog entry, the page carries the state
+        await silkflow.sync_effects()
+        response = await client.get("/", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+
+        # each encoding is tagged apart, so caches never mix them up
+        url = silkflow.core.RUNTIME_URL
+        gzipped = await client.get(url, headers={"Accept-Encoding": "gzip"})
+        identity = await client.get(url, headers={"Accept-Encoding": "identity"})
+        assert gzipped.headers["content-encoding"] == "gzip"
+        assert "content-encoding" not in identity.headers
+        assert gzipped.headers["etag"] != identity.headers["etag"]
+        assert gzipped.headers["vary"] == identity.headers["vary"] == "Accept-Encoding"
+        response = await client.get(
+            url,
+            headers={
+                "Accept-Encoding": "identity",
+                "If-None-Match": gzipped.headers["etag"],
+            },
+        )
+        assert response.status_code == 200
+        assert response.content == identity.content
+        response = await client.get(
+            url,
+            headers={"Accept-Encoding": "gzip", "If-None-Match": gzipped.headers["etag"]},
+        )
+        assert response.status_code == 304
+        assert response.headers["vary"] == "Accept-Encoding"
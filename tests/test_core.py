@@ -1,7 +1,21 @@
 from bs4 import BeautifulSoup
+from collections import deque
+import pytest
+import random
+import re
 import weakref
 
-from silkflow.core import _Effect, Signal, effect
+import silkflow.charts
+
+from silkflow.core import (
+    _Effect,
+    Signal,
+    Stream,
+    component,
+    computed,
+    effect,
+    for_each,
+)
 from silkflow.html import *
 
 
@@ -218,3 +232,638 @@ def test_attribute():
     soup = BeautifulSoup(result.body, "html.parser")
     the_div = list(soup.body.children)[0]
     assert the_div["class"] == ["new", "class"]
+
+
+def test_dynamic_dependencies():
+    mode = Signal("a")
+    a = Signal("A")
+    b = Signal("B")
+
+    @effect
+    def the_mode():
+        return a.value if mode.value == "a" else b.value
+
+    result = the_mode()
+    assert result.html == "A"
+    assert weakref.ref(result) in a.effects
+    assert weakref.ref(result) not in b.effects
+
+    mode.value = "b"
+    _Effect._stale_effects = set()
+    assert result.html == "B"
+    # the effect now follows b and has dropped a
+    assert weakref.ref(result) not in a.effects
+    assert weakref.ref(result) in b.effects
+
+    a.value = "A2"
+    assert len(_Effect._stale_effects) == 0
+
+    b.value = "B2"
+    _Effect._stale_effects = set()
+    assert result.html == "B2"
+
+
+def test_dead_effects_pruned():
+    c1 = Signal(0)
+
+    @effect
+    def _nested():
+        return str(c1.value)
+
+    @effect
+    def test():
+        return div(div(str(c1.value)), _nested())
+
+    result = test()
+    assert len(c1.effects) == 2
+
+    for i in range(1, 10):
+        c1.value = i
+        _Effect._stale_effects = set()
+        assert result.html.endswith(f"<div>{i}</div>{i}</div>")
+        # the replaced child's subscription went with it
+        assert len(c1.effects) == 2
+
+    del result
+    assert len(c1.effects) == 0
+
+
+def test_computed():
+    samples = Signal([1, 2, 3])
+    calls = []
+
+    @computed
+    def average():
+        calls.append(1)
+        return round(sum(samples.value) / len(samples.value))
+
+    @effect
+    def the_average():
+        return str(average.value)
+
+    result = the_average()
+    assert result.html == "2"
+    assert len(calls) == 1
+    assert weakref.ref(result) in average.effects
+
+    # cached
+    assert average.value == 2
+    assert len(calls) == 1
+
+    # recomputed, but the rounded value is unchanged so nothing is flushed
+    samples.value = [1, 2, 3, 2]
+    assert len(calls) == 2
+    assert len(_Effect._stale_effects) == 0
+
+    samples.value = [5, 6, 7]
+    assert len(calls) == 3
+    stale = _Effect._stale_effects
+    _Effect._stale_effects = set()
+    assert [s() for s in stale] == [result]
+    assert result.html == "6"
+
+    with pytest.raises(AttributeError):
+        average.value = 3
+
+
+def test_stale_children_subsumed():
+    _Effect._backlog = deque()
+    _Effect._backlog_offs = 0
+
+    c1 = Signal(0)
+    c2 = Signal(0)
+
+    @effect
+    def _nested():
+        return div(f"_nested {c2.value}, {c1.value}")
+
+    @effect
+    def test():
+        return div(div(f"hi {c1.value}"), _nested())
+
+    held = test()
+    outer = div(held)
+    # as served to a client
+    "".join(str(h) for h in outer)
+    key = held.key
+    nested = held.children[0]
+    assert nested._parent() is held
+
+    # both the nested effect and its parent are stale
+    c2.value = 1
+    c1.value = 1
+    assert set(s() for s in _Effect._stale_effects) == {held, nested}
+
+    _Effect.push_updates()
+    # only the parent is pushed, its html already carries the nested effect
+    assert len(_Effect._backlog) == 1
+    ((k, index, html, outer, _),) = _Effect._backlog[0]
+    assert (k, index) == (key, 0)
+    assert outer == frozenset()
+    assert html == held.html
+    assert "_nested 1, 1" in html
+
+
+def test_cached_html():
+    c1 = Signal(0)
+    c2 = Signal(0)
+
+    @effect
+    def first():
+        return div(f"first {c1.value}")
+
+    @effect
+    def second():
+        return div(f"second {c2.value}")
+
+    result = _Effect(div(first(), second()))
+    html = result.html
+    assert result.html is html
+    first_effect, second_effect = result.children
+    second_html = second_effect.html
+
+    c1.value = 1
+    _Effect._stale_effects = set()
+    # the flush invalidated the ancestors, but not the clean sibling
+    assert result._cache is None
+    assert second_effect._cache is second_html
+    assert (
+        result.html
+        == f'<div key="{first_effect.key}"><div>first 1</div><div>second 0</div></div>'
+    )
+    assert second_effect.html is second_html
+
+
+def test_component():
+    c1 = Signal("v")
+
+    @effect
+    def the_value():
+        return c1.value
+
+    def plain_row(name, value, klass="row"):
+        return tr(td(name), td(value), Class=klass)
+
+    row = component(plain_row)
+
+    result = row("a<b", "1")
+    assert row.__wrapped__ is plain_row
+    assert "".join(result) == "".join(plain_row("a<b", "1"))
+    assert "".join(row("x", "2", klass='"q"')) == "".join(plain_row("x", "2", '"q"'))
+
+    # only elements owning an effect are keyed
+    value = the_value()
+    result = row("b", value)
+    assert value.key is not None
+    assert value.index == 0
+    assert (
+        "".join(str(r) for r in result)
+        == f'<tr Class="row"><td>b</td><td key="{value.key}">v</td></tr>'
+    )
+
+    # effects in attribute slots
+    klass = the_value()
+    result = row("c", "3", klass=klass)
+    assert klass.index == "Class"
+    assert (
+        "".join(str(r) for r in result)
+        == f'<tr Class="v" key="{klass.key}"><td>c</td><td>3</td></tr>'
+    )
+
+    # nested components and element children
+    @component
+    def table_of(a, b):
+        return table(row(a, b), tr(td("static")))
+
+    result = table_of("n", span("s"))
+    assert (
+        "".join(result)
+        == '<table><tr Class="row"><td>n</td><td><span>s</span></td></tr><tr><td>static</td></tr></table>'
+    )
+
+    # components inspecting their arguments fall back to plain calls
+    @component
+    def formatted(x):
+        return div(f"{x:>3}")
+
+    assert "".join(formatted(1)) == "<div>  1</div>"
+    assert "".join(formatted(22)) == "<div> 22</div>"
+
+    @component
+    def typed(x):
+        return span(x if isinstance(x, str) else "other")
+
+    assert "".join(typed("a")) == "<span>a</span>"
+    assert "".join(typed(1)) == "<span>other</span>"
+
+    # None and booleans get templates of their own
+    @component
+    def either(a, b):
+        return span(a if b is None else b)
+
+    assert "".join(either("a", "b")) == "<span>b</span>"
+    assert "".join(either("a", None)) == "<span>a</span>"
+
+    @component
+    def hideable(x, hidden):
+        return div(x, hidden=hidden)
+
+    assert "".join(hideable("a", True)) == "<div hidden>a</div>"
+    assert "".join(hideable("b", "until-found")) == '<div hidden="until-found">b</div>'
+
+    # lookups and membership need hashing, which placeholders refuse
+    colors = {"bad": "red"}
+
+    @component
+    def status(x):
+        return span(x, Class=colors.get(x, "black"))
+
+    assert "".join(status("bad")) == '<span Class="red">bad</span>'
+    assert "".join(status("good")) == '<span Class="black">good</span>'
+
+    @component
+    def flagged(x):
+        return span("!" if x in {"bad"} else x)
+
+    assert "".join(flagged("bad")) == "<span>!</span>"
+    assert "".join(flagged("good")) == "<span>good</span>"
+
+    # types are checked against plain calls, and compiled for apart
+    @component
+    def exact(x):
+        return span(x if type(x) is str else "other")
+
+    assert "".join(exact("a")) == "<span>a</span>"
+    assert "".join(exact("b")) == "<span>b</span>"
+    assert "".join(exact(1)) == "<span>other</span>"
+
+    # lists of elements are unpacked as children, keying their effects
+    @component
+    def listing(items):
+        return ul(items)
+
+    assert "".join(listing([li("a"), li("b")])) == "<ul><li>a</li><li>b</li></ul>"
+    assert "".join(listing([li("c")])) == "<ul><li>c</li></ul>"
+    first, second = the_value(), the_value()
+    result = listing([first, second])
+    assert first.key is not None and first.key == second.key
+    assert (first.index, second.index) == (0, 1)
+    assert "".join(str(r) for r in result) == f'<ul key="{first.key}">vv</ul>'
+    # an element is placed as it is
+    assert "".join(listing(li("d"))) == "<ul><li>d</li></ul>"
+
+
+def test_component_signals():
+    c1 = Signal("v")
+
+    # signals read by a component aren't frozen into its template
+    @component
+    def current(x):
+        return span(x, c1.value)
+
+    @effect
+    def the_row():
+        return div(current("a"))
+
+    row = the_row()
+    assert row.html == "<div><span>av</span></div>"
+    assert row._deps == {c1}
+
+    c1.value = "w"
+    assert row.html == "<div><span>aw</span></div>"
+    assert row._deps == {c1}
+
+
+def test_keys():
+    @effect
+    def a_str():
+        return "str"
+
+    first = a_str()
+    div(first)
+    # elements without effects don't consume keys
+    for _ in range(100):
+        div(span("static"), Class="x")
+    second = a_str()
+    div(second)
+
+    assert first.key != second.key
+    assert int(second.key, 36) == int(first.key, 36) + 1
+
+
+def test_coalesce():
+    entries = [
+        (("c", 0, "child 1", frozenset({("p", 0)}), None),),
+        (
+            ("p", 0, "parent 1", frozenset(), None),
+            ("x", "Class", "a", frozenset(), None),
+        ),
+        (("c2", 0, "child 2", frozenset({("p", 0)}), None),),
+        (("x", "Class", "b", frozenset(), None),),
+    ]
+
+    # "c" was within the replaced parent, "x" was set again
+    assert _Effect.coalesce(entries) == [
+        ("p", 0, "parent 1"),
+        ("c2", 0, "child 2"),
+        ("x", "Class", "b"),
+    ]
+    assert _Effect.coalesce(entries[:1]) == [("c", 0, "child 1")]
+    assert _Effect.coalesce([]) == []
+
+    # splices are sent to clients holding the fragment they were taken against
+    entries = [(("c", 0, "child 2", frozenset(), (3, 6, 0, "2")),)]
+    assert _Effect.coalesce(entries, 4, 3) == [("c", 0, [6, 0, "2"])]
+    assert _Effect.coalesce(entries, 4, 4) == [("c", 0, "child 2")]
+    assert _Effect.coalesce(entries, 3, 3) == [("c", 0, "child 2")]
+    assert _Effect.coalesce(entries, 4) == [("c", 0, "child 2")]
+
+    # positions before a list operation aren't those after it
+    entries = [
+        (("l", 1, "item 1", frozenset({("p", 0)}), None),),
+        (("l", ("m", 1, 0), "", frozenset({("p", 0)}), None),),
+        (("l", 1, "item 2", frozenset({("p", 0)}), None),),
+    ]
+    assert _Effect.coalesce(entries) == [
+        ("l", 1, "item 1"),
+        ("l", ("m", 1, 0), ""),
+        ("l", 1, "item 2"),
+    ]
+    entries.append((("p", 0, "parent", frozenset(), None),))
+    assert _Effect.coalesce(entries) == [("p", 0, "parent")]
+
+
+def test_diff(monkeypatch):
+    monkeypatch.setattr("silkflow.core.DIFF_MIN_SIZE", 8)
+
+    e = _Effect(["x"])
+    # nothing sent yet
+    assert e._diff("0123456789") is None
+
+    e._sent = (3, "0123456789")
+    assert e._diff("01234x6789") == (3, 5, 4, "x")
+    # not worth it
+    assert e._diff("abcdefghij") is None
+
+    # counted in UTF-16 code units, as clients do
+    e._sent = (3, "\U0001F600123456789")
+    assert e._diff("\U0001F6001234x6789") == (3, 6, 4, "x")
+
+    # since re-rendered within an enclosing fragment
+    e._sent = (3, "0123456789")
+    parent = _Effect([e])
+    parent._sent = (4, None)
+    assert e._diff("01234x6789") is None
+
+
+
+def test_for_each():
+    _Effect._stale_effects = set()
+    _Effect._backlog = deque()
+
+    items = Signal([(i, f"v{i}") for i in range(5)])
+    rows = for_each(items, lambda v: v[0], lambda v: li(v[1]))
+    outer = ul(rows)
+    # as served to a client
+    soup = BeautifulSoup("".join(str(h) for h in outer), "html.parser")
+    children = [str(c) for c in soup.find("ul").children]
+    assert children == [f"<li>v{i}</li>" for i in range(5)]
+
+    def apply():
+        # as a client would, returning the operations
+        if not _Effect.push_updates():
+            return []
+        indexes = []
+        for key, index, html, _, _ in _Effect._backlog[-1]:
+            assert key == rows.key
+            indexes.append(index)
+            if not isinstance(index, tuple):
+                children[index] = html
+            elif index[0] == "-":
+                children.pop(index[1])
+            elif index[0] == "+":
+                children.insert(index[1], html)
+            else:
+                children.insert(index[2], children.pop(index[1]))
+        assert children == [i.html for i in rows.children]
+        return indexes
+
+    # appending costs one insert
+    items.value = items.value + [(5, "v5")]
+    assert apply() == [("+", 5)]
+    # moving the last item first, or the first last, costs one move
+    items.value = items.value[-1:] + items.value[:-1]
+    assert apply() == [("m", 5, 0)]
+    items.value = items.value[1:] + items.value[:1]
+    assert apply() == [("m", 0, 5)]
+    # a changed value re-renders just its item
+    items.value = [(k, "changed" if k == 2 else v) for k, v in items.value]
+    assert apply() == [2]
+    assert children[2] == "<li>changed</li>"
+
+    random.seed(1)
+    for _ in range(50):
+        values = random.sample(items.value, random.randint(0, len(items.value)))
+        values += [(random.randint(6, 1000), "new") for _ in range(random.randint(0, 3))]
+        items.value = list(dict(values).items())
+        apply()
+
+    # items are positioned by child index
+    with pytest.raises(ValueError):
+        div(for_each(items, lambda v: v[0], li), "more")
+
+    # rows are sent whole, for clients to parse within the body they go in
+    laps = Signal([(1, "1:02")])
+    body = for_each(laps, lambda v: v[0], lambda v: tr(td(str(v[0])), td(v[1])))
+    "".join(str(h) for h in table(tbody(body)))
+    laps.value = laps.value + [(2, "0:58")]
+    _Effect.push_updates()
+    assert [u[:3] for u in _Effect._backlog[-1]] == [
+        (body.key, ("+", 1), "<tr><td>2</td><td>0:58</td></tr>")
+    ]
+
+
+def test_stream():
+    _Effect._stale_effects = set()
+    _Effect._backlog = deque()
+
+    log = Stream(["a", "b"], maxlen=3)
+    view = log.each(lambda entry: li(entry))
+    outer = ul(view)
+    "".join(str(h) for h in outer)
+    children = [f"<li>{v}</li>" for v in log.value]
+
+    @effect
+    def count():
+        return str(len(log.value))
+
+    counter = count()
+    div(counter)
+    str(counter)
+
+    def apply():
+        _Effect.push_updates()
+        indexes = []
+        for key, index, html, _, _ in _Effect._backlog[-1]:
+            if key != view.key:
+                continue
+            indexes.append((index, html))
+            end, maxlen = index
+            if end == ">":
+                children.append(html)
+                del children[: max(0, len(children) - maxlen)]
+            else:
+                children.insert(0, html)
+                del children[maxlen:]
+        assert children == [f"<li>{v}</li>" for v in log.value]
+        assert view.html == "".join(children)
+        return indexes
+
+    log.append("c")
+    # served meanwhile, pages match the backlog state
+    assert view.html == "<li>a</li><li>b</li>"
+    assert apply() == [((">", 3), "<li>c</li>")]
+    # effects reading the value re-render as usual
+    assert (counter.key, 0, "3") in [u[:3] for u in _Effect._backlog[-1]]
+    # only the new entry is sent, however long the stream
+    log.append("d")
+    assert apply() == [((">", 3), "<li>d</li>")]
+    assert log.value == ("b", "c", "d")
+    log.prepend("z")
+    assert apply() == [(("<", 3), "<li>z</li>")]
+    assert log.value == ("z", "b", "c")
+
+    with pytest.raises(AttributeError):
+        log.value = ()
+
+    # a race log of rows, sent whole for clients to parse within the body
+    laps = Stream(maxlen=2)
+    rows = laps.each(lambda lap: tr(td(str(lap[0])), td(lap[1])))
+    outer = table(tbody(rows))
+    soup = BeautifulSoup("".join(str(h) for h in outer), "html.parser")
+    assert soup.find("tbody")["key"] == rows.key
+    laps.append((1, "1:02"))
+    laps.prepend((0, "1:10"))
+    _Effect.push_updates()
+    assert [u[:3] for u in _Effect._backlog[-1]] == [
+        (rows.key, (">", 2), "<tr><td>1</td><td>1:02</td></tr>"),
+        (rows.key, ("<", 2), "<tr><td>0</td><td>1:10</td></tr>"),
+    ]
+
+
+
+def test_fragment_contexts():
+    from silkflow.core import _runtime
+
+    # the client parses fragments within wrappers matching their parent, as
+    # rows and cells outside a table are dropped leaving only their text
+    runtime = _runtime.decode()
+    wrappers = {
+        context: (opening, closing, int(depth))
+        for context, opening, closing, depth in re.findall(
+            r"(\w+): \['([^']*)', '([^']*)', (\d+)\]", runtime
+        )
+    }
+    assert {"TABLE", "THEAD", "TBODY", "TFOOT", "TR", "svg"} <= set(wrappers)
+    assert "wrappers.hasOwnProperty(parent.tagName) ? parent.tagName" in runtime
+
+    fragments = {
+        "TBODY": "<tr><td>1</td><td>1:02</td></tr>",
+        "THEAD": "<tr><th>lap</th></tr>",
+        "TR": "<td>1:02</td>",
+        "TABLE": "<tbody><tr><td>1</td></tr></tbody>",
+        "svg": '<path d="M0 0L1 1"/>',
+    }
+    for context, fragment in fragments.items():
+        opening, closing, depth = wrappers[context]
+        assert re.findall(r"</(\w+)>", closing) == re.findall(r"<(\w+)>", opening)[::-1]
+        container = BeautifulSoup(opening + fragment + closing, "html.parser")
+        for _ in range(depth):
+            container = next(container.children)
+        # descending to the parent the fragment goes in
+        assert container.name == context.lower()
+        assert list(container.children) == list(
+            BeautifulSoup(fragment, "html.parser").children
+        )
+
+
+def test_charts(monkeypatch):
+    from silkflow.charts import Bars, Sparkline, _Chart
+
+    _Effect._stale_effects = set()
+    _Effect._backlog = deque()
+
+    chart = Sparkline(width=4, height=10, maximum=10.0, window=8)
+    page = chart()
+    "".join(str(h) for h in page)
+    group = BeautifulSoup("".join(str(h) for h in page), "html.parser").find("g")
+
+    # two samples a column, averaged, sent with the next flush
+    chart.add(2.0)
+    chart.add(4.0)
+    assert len(_Effect._backlog) == 0
+    assert _Effect.push_updates()
+    assert len(_Effect._backlog) == 1
+    assert set(u[1:3] for u in _Effect._backlog[-1]) == {
+        ((">", 4), '<path d="M-1 7.0L0 7.0"/>'),
+        ("transform", "translate(3,0)"),
+    }
+    assert all(u[0] == group["key"] for u in _Effect._backlog[-1])
+
+    # a column costs the same however many have been drawn
+    for i in range(100):
+        chart.add(i % 10)
+        chart.add(i % 10)
+        assert _Effect.push_updates()
+        assert len(_Effect._backlog[-1]) == 2
+    assert "".join(str(h) for h in page).count("<path") == 4
+    assert 'transform="translate(-97,0)"' in "".join(str(h) for h in page)
+
+    # columns drawn between flushes are sent together
+    for i in range(3):
+        chart.add(5.0)
+        chart.add(5.0)
+    assert _Effect.push_updates()
+    updates = _Effect._backlog[-1]
+    assert [u[1] for u in updates if u[1] != "transform"] == [(">", 4)] * 3
+    assert ("transform", "translate(-100,0)") in [u[1:3] for u in updates]
+
+    # clamped to the range
+    bars = Bars(width=2, height=10, maximum=10.0)
+    page = bars()
+    bars.add(20.0)
+    _Effect.push_updates()
+    assert '<rect height="10.0" width="1" x="0" y="0.0"/>' in "".join(
+        str(h) for h in page
+    )
+
+    with pytest.raises(ValueError):
+        Sparkline(minimum=1.0, maximum=1.0)
+    with pytest.raises(TypeError):
+        _Chart()
+
+    # x is rebased now and then, re-rendering the chart whole
+    monkeypatch.setattr(silkflow.charts, "REBASE_COLUMNS", 10)
+    bars = Bars(width=4, height=10, maximum=10.0)
+    page = bars()
+    svg = BeautifulSoup("".join(str(h) for h in page), "html.parser").find("svg")
+    rebases = 0
+    for i in range(25):
+        rebasing = bars._count.value >= 10
+        bars.add(i % 10)
+        _Effect.push_updates()
+        if rebasing:
+            rebases += 1
+            # the whole group, its columns moved back to start from the width
+            assert [u[:2] for u in _Effect._backlog[-1]] == [(svg["key"], 0)]
+            assert bars._count.value == 5
+        else:
+            assert len(_Effect._backlog[-1]) == 2
+    assert rebases == 3
+    html = "".join(str(h) for h in page)
+    assert 'transform="translate(-3,0)"' in html
+    xs = [int(rect["x"]) for rect in BeautifulSoup(html, "html.parser").find_all("rect")]
+    assert xs == [3, 4, 5, 6]
+    assert [rect["y"] for rect in BeautifulSoup(html, "html.parser").find_all("rect")] == [
+        f"{10 - v:.1f}" for v in (1, 2, 3, 4)
+    ]